@@ -0,0 +1,61 @@
+"""Micro-benchmark: email renders per second with per-call compilation vs the template registry.
+
+    cd backend && python benchmark_templates.py [--seconds 2]
+"""
+import argparse
+import time
+
+from jinja2 import Template
+
+from server import EmailTemplates, template_registry
+
+SAMPLE_DATA = {
+    "booking_confirmation": {
+        "customer_name": "John Doe",
+        "unit_name": "Enclosed Parking 12x30",
+        "unit_size": "12x30",
+        "amount": 200.0,
+        "move_in_date": "January 01, 2025",
+        "booking_id": "3f1c2a9e-0000-4000-8000-000000000000",
+        "manage_booking_url": "#"
+    },
+    "payment_confirmation": {
+        "customer_name": "John Doe",
+        "amount": 200.0,
+        "payment_date": "January 01, 2025",
+        "unit_name": "Enclosed Parking 12x30",
+        "transaction_id": "3f1c2a9e",
+        "next_due_date": "1st of next month"
+    }
+}
+
+SOURCES = {
+    "booking_confirmation": EmailTemplates.BOOKING_CONFIRMATION,
+    "payment_confirmation": EmailTemplates.PAYMENT_CONFIRMATION
+}
+
+
+def renders_per_second(render, seconds: float) -> float:
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        render()
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=2.0, help="duration of each measurement")
+    args = parser.parse_args()
+
+    template_registry.warm()
+    print(f"{'template':<24}{'before (renders/s)':>20}{'after (renders/s)':>20}{'speedup':>10}")
+    for name, data in SAMPLE_DATA.items():
+        before = renders_per_second(lambda: Template(SOURCES[name]).render(**data), args.seconds)
+        after = renders_per_second(lambda: template_registry.render(name, **data), args.seconds)
+        print(f"{name:<24}{before:>20,.0f}{after:>20,.0f}{after / before:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""Fill the configured MongoDB with synthetic, production-scale data for benchmarking.
+
+Generates locations, physical units, virtual unit mappings, customers, non-overlapping
+bookings and funnel events, then rebuilds the derived analytics and filter facets.
+
+    cd backend && python generate_load_data.py --physical-units 5000 --virtual-units 12000 \\
+        --customers 50000 --bookings 100000 --funnel-events 1000000
+"""
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Iterator, List
+
+import server
+from server import (
+    Booking, BookingStatus, Customer, FunnelEvent, Location, PaymentOption, PhysicalUnit,
+    PricingPeriod, UnitType, VirtualUnit, calculate_loyalty_tier, customer_document, db
+)
+
+AMENITIES = ["security", "covered", "electric", "climate_control", "24hr_access", "gated", "water", "dump_station"]
+SIZES = ["10x10", "10x20", "10x25", "12x25", "12x30", "12x35", "14x35", "14x40", "16x40", "16x50"]
+FIRST_NAMES = ["John", "Sarah", "Mike", "Emily", "David", "Maria", "James", "Linda", "Robert", "Karen"]
+LAST_NAMES = ["Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Wilson", "Moore"]
+CITIES = [("Springfield", "IL"), ("Riverside", "CA"), ("Franklin", "TN"), ("Madison", "WI"), ("Salem", "OR")]
+# Event types weighted roughly like storefront traffic
+FUNNEL_EVENT_WEIGHTS = {
+    "page_view": 50, "unit_viewed": 25, "filter_used": 15, "booking_started": 5,
+    "booking_abandoned": 3, "booking_completed": 1, "banner_clicked": 1
+}
+
+
+def batched(documents: Iterator[dict], batch_size: int) -> Iterator[List[dict]]:
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def insert_all(collection, documents: Iterator[dict], batch_size: int) -> int:
+    """Insert generated documents in unordered batches, returning the number inserted"""
+    inserted = 0
+    for batch in batched(documents, batch_size):
+        await collection.insert_many(batch, ordered=False)
+        inserted += len(batch)
+    return inserted
+
+
+def generate_locations(rng: random.Random, count: int) -> List[Location]:
+    locations = []
+    for i in range(count):
+        city, state = rng.choice(CITIES)
+        locations.append(Location(
+            name=f"{city} Storage Center {i + 1}",
+            address=f"{rng.randint(100, 9999)} Main Street",
+            city=city,
+            state=state,
+            zip_code=f"{rng.randint(10000, 99999)}",
+            phone=f"(555) {rng.randint(100, 999)}-{rng.randint(1000, 9999)}",
+            email=f"location{i + 1}@premiumstorage.com",
+            amenities=rng.sample(AMENITIES, 3)
+        ))
+    return locations
+
+
+def generate_physical_units(rng: random.Random, count: int, locations: List[Location]) -> List[PhysicalUnit]:
+    units = []
+    for i in range(count):
+        location = locations[i % len(locations)]
+        units.append(PhysicalUnit(
+            unit_number=f"U-{i + 1:06d}",
+            actual_size=rng.choice(SIZES),
+            location=f"{location.name} - Row {i // 50 + 1}",
+            amenities=rng.sample(AMENITIES, rng.randint(1, 4)),
+            base_price=float(rng.randint(80, 400))
+        ))
+    return units
+
+
+def generate_virtual_units(rng: random.Random, count: int, physical_units: List[PhysicalUnit]) -> Iterator[dict]:
+    for i in range(count):
+        physical_unit = physical_units[i % len(physical_units)]
+        unit_type = rng.choice(list(UnitType))
+        monthly_price = physical_unit.base_price * rng.uniform(0.8, 1.2)
+        yield VirtualUnit(
+            physical_unit_id=physical_unit.id,
+            unit_type=unit_type,
+            display_size=physical_unit.actual_size,
+            display_name=f"{unit_type.value.replace('_', ' ').title()} {physical_unit.actual_size}",
+            daily_price=round(monthly_price / 25, 2),
+            weekly_price=round(monthly_price / 4, 2),
+            monthly_price=round(monthly_price, 2),
+            amenities=physical_unit.amenities
+        ).dict()
+
+
+def generate_customers(rng: random.Random, count: int, days: int) -> List[Customer]:
+    now = datetime.utcnow()
+    customers = []
+    for i in range(count):
+        first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        loyalty_points = rng.randint(0, 5000)
+        customers.append(Customer(
+            email=f"{first_name.lower()}.{last_name.lower()}.{i}@example.com",
+            phone=f"+1555{rng.randint(1000000, 9999999)}",
+            first_name=first_name,
+            last_name=last_name,
+            customer_type=rng.choices(["individual", "business", "vip"], [85, 12, 3])[0],
+            acquisition_source=rng.choice(["web", "referral", "ads"]),
+            loyalty_points=loyalty_points,
+            loyalty_tier=calculate_loyalty_tier(loyalty_points),
+            marketing_consent=rng.random() < 0.8,
+            tags=rng.sample(["rv", "boat", "long_term", "seasonal", "commercial"], rng.randint(0, 2)),
+            created_at=now - timedelta(days=rng.uniform(0, days))
+        ))
+    return customers
+
+
+def generate_bookings(
+    rng: random.Random, count: int, virtual_units: List[dict], customers: List[Customer], days: int
+) -> Iterator[dict]:
+    """Bookings that never overlap on a physical unit, walking each unit's calendar forward"""
+    now = datetime.utcnow()
+    next_free = {}
+    for _ in range(count):
+        virtual_unit = rng.choice(virtual_units)
+        physical_unit_id = virtual_unit["physical_unit_id"]
+        start = next_free.get(physical_unit_id, now - timedelta(days=days)) + timedelta(days=rng.randint(0, 14))
+        end = start + timedelta(days=rng.randint(7, 120))
+        next_free[physical_unit_id] = end
+        customer = rng.choice(customers)
+        pricing_period = rng.choice(list(PricingPeriod))
+        yield Booking(
+            virtual_unit_id=virtual_unit["id"],
+            physical_unit_id=physical_unit_id,
+            customer_name=f"{customer.first_name} {customer.last_name}",
+            customer_email=customer.email,
+            customer_phone=customer.phone,
+            customer_id=customer.id,
+            payment_option=rng.choice(list(PaymentOption)),
+            pricing_period=pricing_period,
+            start_date=start,
+            end_date=end,
+            total_price=virtual_unit[f"{pricing_period.value}_price"],
+            status=BookingStatus.MAINTENANCE if rng.random() < 0.02 else BookingStatus.BOOKED,
+            created_at=start - timedelta(days=rng.randint(0, 30))
+        ).dict()
+
+
+def generate_funnel_events(
+    rng: random.Random, count: int, locations: List[Location], virtual_units: List[dict], days: int
+) -> Iterator[dict]:
+    now = datetime.utcnow()
+    event_types = list(FUNNEL_EVENT_WEIGHTS)
+    weights = list(FUNNEL_EVENT_WEIGHTS.values())
+    sessions = max(1, count // 8)
+    for _ in range(count):
+        event_type = rng.choices(event_types, weights)[0]
+        unit_id = rng.choice(virtual_units)["id"] if virtual_units and event_type != "page_view" else None
+        event = FunnelEvent(
+            session_id=f"session_{rng.randrange(sessions)}",
+            event_type=event_type,
+            unit_id=unit_id,
+            timestamp=now - timedelta(seconds=rng.uniform(0, days * 86400)),
+            metadata={"location_id": rng.choice(locations).id}
+        ).dict()
+        # Stored as if ingested when it happened, so retention and archiving spread over the history
+        yield {"_id": event["id"], **event, "ingested_at": event["timestamp"]}
+
+
+async def generate(args):
+    # One generator per data set keeps output reproducible while batches insert concurrently
+    def rng(name: str) -> random.Random:
+        return random.Random(f"{args.seed}-{name}")
+
+    started = time.perf_counter()
+    if not args.append:
+        await asyncio.gather(*(db[name].delete_many({}) for name in server.SAMPLE_DATA_COLLECTIONS))
+    await server.configure_funnel_events_collection()
+    await server.ensure_indexes()
+
+    locations = generate_locations(rng("locations"), args.locations)
+    physical_units = generate_physical_units(rng("physical_units"), args.physical_units, locations)
+    customers = generate_customers(rng("customers"), args.customers, args.days)
+    virtual_units = list(generate_virtual_units(rng("virtual_units"), args.virtual_units, physical_units))
+
+    counts = dict(zip(
+        ["locations", "physical_units", "virtual_units", "customers"],
+        await asyncio.gather(
+            insert_all(db.locations, (location.dict() for location in locations), args.batch_size),
+            insert_all(db.physical_units, (unit.dict() for unit in physical_units), args.batch_size),
+            insert_all(db.virtual_units, iter(virtual_units), args.batch_size),
+            insert_all(db.customers, (customer_document(customer) for customer in customers), args.batch_size)
+        )
+    ))
+    counts["bookings"], counts["funnel_events"] = await asyncio.gather(
+        insert_all(db.bookings, generate_bookings(rng("bookings"), args.bookings, virtual_units, customers, args.days), args.batch_size),
+        insert_all(
+            db.funnel_events, generate_funnel_events(rng("funnel_events"), args.funnel_events, locations, virtual_units, args.days),
+            args.batch_size
+        )
+    )
+
+    # Derived state the API would otherwise maintain on each write
+    await asyncio.gather(
+        server.recount_customer_bookings(),
+        server.rebuild_funnel_rollups(),
+        server.rebuild_funnel_sessions(),
+        server.refresh_filter_facets()
+    )
+    for name, count in counts.items():
+        print(f"{name:>16}: {count}")
+    print(f"Generated in {time.perf_counter() - started:.1f}s")
+    server.client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--locations", type=int, default=10)
+    parser.add_argument("--physical-units", type=int, default=1000)
+    parser.add_argument("--virtual-units", type=int, default=2500, help="virtual mappings, spread across physical units")
+    parser.add_argument("--customers", type=int, default=10000)
+    parser.add_argument("--bookings", type=int, default=20000)
+    parser.add_argument("--funnel-events", type=int, default=200000)
+    parser.add_argument("--days", type=int, default=90, help="history spread of timestamps")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--append", action="store_true", help="keep existing data instead of clearing it first")
+    args = parser.parse_args()
+    if min(args.locations, args.physical_units, args.virtual_units, args.customers) < 1:
+        parser.error("locations, physical units, virtual units and customers must be at least 1")
+    asyncio.run(generate(args))
+
+
+if __name__ == "__main__":
+    main()
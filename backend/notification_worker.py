@@ -0,0 +1,71 @@
+"""Notification outbox worker.
+
+Drains db.notification_outbox outside the API process, retrying failed
+sends with exponential backoff until they are delivered or dead-lettered,
+runs queued bulk campaigns, exports funnel events to
+FUNNEL_EVENTS_ARCHIVE_DIR before retention expires them, and runs the
+backfills too slow for API startup.
+
+    cd backend && python notification_worker.py
+"""
+import asyncio
+import os
+import signal
+
+import server
+
+OUTBOX_POLL_INTERVAL_SECONDS = float(os.environ.get('OUTBOX_POLL_INTERVAL_SECONDS', '2'))
+FUNNEL_ARCHIVE_INTERVAL_SECONDS = float(os.environ.get('FUNNEL_ARCHIVE_INTERVAL_SECONDS', '3600'))
+FUNNEL_ROLLUP_SWEEP_INTERVAL_SECONDS = float(os.environ.get('FUNNEL_ROLLUP_SWEEP_INTERVAL_SECONDS', '300'))
+
+
+async def poll(name: str, process_once, stop: asyncio.Event, interval: float = OUTBOX_POLL_INTERVAL_SECONDS):
+    """Call process_once until stopped, sleeping only when it found no work"""
+    while not stop.is_set():
+        try:
+            processed = await process_once()
+        except Exception as e:
+            server.logger.error(f"{name} batch failed: {e}")
+            processed = 0
+        if not processed:
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def run_backfills():
+    """One-time migrations that scan whole collections"""
+    try:
+        await server.run_migration("booking_customer_ids", server.backfill_booking_customer_ids)
+        await server.run_migration("funnel_event_ingested_at", server.backfill_funnel_event_ingested_at)
+        await server.run_migration("funnel_rollups", server.rebuild_funnel_rollups)
+        await server.run_migration("funnel_sessions", server.rebuild_funnel_sessions)
+    except Exception as e:
+        server.logger.error(f"Backfill failed: {e}")
+
+
+async def run_worker():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await server.ensure_indexes()
+    server.logger.info("Notification worker started")
+    # Campaigns run alongside the outbox so a large send never delays confirmations
+    loops = [
+        poll("Outbox", server.process_outbox_once, stop),
+        poll("Campaign", server.process_campaigns_once, stop),
+        poll("Funnel rollup sweep", server.sweep_pending_funnel_events, stop, FUNNEL_ROLLUP_SWEEP_INTERVAL_SECONDS),
+        run_backfills()
+    ]
+    if server.FUNNEL_EVENTS_ARCHIVE_DIR:
+        loops.append(poll("Funnel archive", server.archive_funnel_events, stop, FUNNEL_ARCHIVE_INTERVAL_SECONDS))
+    await asyncio.gather(*loops)
+    server.logger.info("Notification worker stopped")
+    server.client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_worker())
@@ -1,28 +1,80 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Query, BackgroundTasks
+from fastapi import FastAPI, APIRouter, HTTPException, Query, Header, Request, Response
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import PlainTextResponse, StreamingResponse
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReplaceOne, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
+import io
 import os
+import csv
+import gzip
+import json
+import math
+import time
+import hashlib
+import base64
+import asyncio
 import logging
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
 from pathlib import Path
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
 from typing import List, Optional, Dict, Any
+import re
 import uuid
-from datetime import datetime, timedelta
+import random
+from datetime import datetime, timedelta, timezone
 from enum import Enum
+import bson
+from bson import json_util
+from bson.errors import InvalidDocument
 
 # Integration services
 import stripe
 from twilio.rest import Client as TwilioClient
+from twilio.http.http_client import TwilioHttpClient
 from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Email, To, Content
-from jinja2 import Template
+from sendgrid.helpers.mail import Mail, Email, To, Content, Personalization, Substitution
+from jinja2 import Environment, DictLoader, FileSystemBytecodeCache, Template
+from jinja2.exceptions import SecurityError
+from jinja2.sandbox import SandboxedEnvironment
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # Integration Services
-class StripeService:
+
+# Blocking SDK calls run on this bounded pool instead of the event loop
+integration_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('INTEGRATION_THREAD_POOL_SIZE', '16')),
+    thread_name_prefix="integrations"
+)
+
+class AsyncProviderMixin:
+    """Async execution path for a provider SDK: thread pool, per-provider concurrency limit and timeout"""
+    provider_name = "Provider"
+    semaphore: asyncio.Semaphore
+    timeout_seconds: float
+    
+    async def run_blocking(self, func, *args, **kwargs) -> dict:
+        await self.semaphore.acquire()
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(integration_executor, functools.partial(func, *args, **kwargs))
+        # A timed-out call keeps its executor thread, so its permit is held until the call returns
+        future.add_done_callback(lambda _: self.semaphore.release())
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout=self.timeout_seconds)
+        except asyncio.TimeoutError:
+            return {"success": False, "error": f"{self.provider_name} request timed out"}
+
+class StripeService(AsyncProviderMixin):
+    provider_name = "Stripe"
+    semaphore = asyncio.Semaphore(int(os.environ.get('STRIPE_MAX_CONCURRENCY', '8')))
+    timeout_seconds = float(os.environ.get('STRIPE_TIMEOUT_SECONDS', '20'))
+    
     def __init__(self, api_key: str = None):
         if api_key:
             stripe.api_key = api_key
@@ -75,11 +127,27 @@ class StripeService:
             }
         except Exception as e:
             return {"success": False, "error": str(e)}
+    
+    async def create_checkout_session_async(self, *args, **kwargs):
+        return await self.run_blocking(self.create_checkout_session, *args, **kwargs)
+    
+    async def get_payment_status_async(self, session_id: str):
+        return await self.run_blocking(self.get_payment_status, session_id)
 
-class TwilioService:
+# Pooled HTTP connections with a client-side timeout matching the async one
+stripe.default_http_client = stripe.http_client.RequestsClient(timeout=StripeService.timeout_seconds)
+
+class TwilioService(AsyncProviderMixin):
+    provider_name = "Twilio"
+    semaphore = asyncio.Semaphore(int(os.environ.get('TWILIO_MAX_CONCURRENCY', '8')))
+    timeout_seconds = float(os.environ.get('TWILIO_TIMEOUT_SECONDS', '15'))
+    
     def __init__(self, account_sid: str = None, auth_token: str = None, from_number: str = None):
         if account_sid and auth_token:
-            self.client = TwilioClient(account_sid, auth_token)
+            self.client = TwilioClient(
+                account_sid, auth_token,
+                http_client=TwilioHttpClient(pool_connections=True, timeout=self.timeout_seconds)
+            )
             self.from_number = from_number
         else:
             self.client = None
@@ -101,11 +169,19 @@ class TwilioService:
             }
         except Exception as e:
             return {"success": False, "error": str(e)}
+    
+    async def send_sms_async(self, to_number: str, message: str):
+        return await self.run_blocking(self.send_sms, to_number, message)
 
-class EmailService:
+class EmailService(AsyncProviderMixin):
+    provider_name = "SendGrid"
+    semaphore = asyncio.Semaphore(int(os.environ.get('SENDGRID_MAX_CONCURRENCY', '8')))
+    timeout_seconds = float(os.environ.get('SENDGRID_TIMEOUT_SECONDS', '15'))
+    
     def __init__(self, api_key: str = None, from_email: str = None):
         if api_key:
             self.sg = SendGridAPIClient(api_key=api_key)
+            self.sg.client.timeout = self.timeout_seconds
             self.from_email = from_email
         else:
             self.sg = None
@@ -132,6 +208,38 @@ class EmailService:
             }
         except Exception as e:
             return {"success": False, "error": str(e)}
+    
+    async def send_email_async(self, to_email: str, subject: str, html_content: str, text_content: str = None):
+        return await self.run_blocking(self.send_email, to_email, subject, html_content, text_content)
+    
+    def send_bulk_email(self, recipients: List[tuple], subject: str, html_content: str):
+        """Send one request with a personalization per (email, substitutions) recipient"""
+        try:
+            if not self.sg:
+                return {"success": False, "error": "SendGrid not configured"}
+            
+            mail = Mail(
+                from_email=Email(self.from_email),
+                subject=subject,
+                html_content=Content("text/html", html_content)
+            )
+            for to_email, substitutions in recipients:
+                personalization = Personalization()
+                personalization.add_to(To(to_email))
+                for tag, value in substitutions.items():
+                    personalization.add_substitution(Substitution(tag, value))
+                mail.add_personalization(personalization)
+            
+            response = self.sg.send(mail)
+            return {
+                "success": True,
+                "status_code": response.status_code
+            }
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    async def send_bulk_email_async(self, recipients: List[tuple], subject: str, html_content: str):
+        return await self.run_blocking(self.send_bulk_email, recipients, subject, html_content)
 
 # Email Templates
 class EmailTemplates:
@@ -252,6 +360,57 @@ Your storage is secure. Next payment due 1st of next month.
 Facility hours: 6AM-10PM daily. Need help? Call (555) 123-4567
         """.strip()
 
+# Template registry
+class TemplateRegistry:
+    """Compiles email templates once and caches DB-defined templates by version
+
+    Built-in templates ship with the app and use the plain environment; anything stored in
+    the database or sent with a campaign is user-editable and only compiled in the sandbox.
+    """
+    BUILTIN_TEMPLATES = {
+        "booking_confirmation": EmailTemplates.BOOKING_CONFIRMATION,
+        "payment_confirmation": EmailTemplates.PAYMENT_CONFIRMATION
+    }
+    
+    def __init__(self, bytecode_cache_dir: Optional[str] = None):
+        self.environment = Environment(
+            loader=DictLoader(self.BUILTIN_TEMPLATES),
+            bytecode_cache=FileSystemBytecodeCache(bytecode_cache_dir),
+            auto_reload=False
+        )
+        self.sandbox = SandboxedEnvironment(auto_reload=False)
+        # template id -> (version, compiled template)
+        self._db_templates: Dict[str, tuple] = {}
+    
+    def warm(self):
+        for name in self.BUILTIN_TEMPLATES:
+            self.environment.get_template(name)
+    
+    def render(self, name: str, **data) -> str:
+        return self.environment.get_template(name).render(**data)
+    
+    def from_string(self, source: str) -> Template:
+        """Compile user-supplied template source in the sandboxed environment"""
+        return self.sandbox.from_string(source)
+    
+    def get_db_template(self, template: dict) -> Template:
+        """Compiled template for a NotificationTemplate document, recompiled when its version changes"""
+        version = template.get("version", 1)
+        cached = self._db_templates.get(template["id"])
+        if cached and cached[0] == version:
+            return cached[1]
+        compiled = self.from_string(template["content"])
+        self._db_templates[template["id"]] = (version, compiled)
+        return compiled
+    
+    def render_db_template(self, template: dict, **data) -> str:
+        return self.get_db_template(template).render(**data)
+    
+    def invalidate(self, template_id: str):
+        self._db_templates.pop(template_id, None)
+
+template_registry = TemplateRegistry(os.environ.get('TEMPLATE_BYTECODE_CACHE_DIR'))
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
@@ -260,45 +419,533 @@ stripe_service = StripeService()
 twilio_service = TwilioService()
 email_service = EmailService()
 
+# Request metrics: per-request latency, Mongo command counts and time, documents
+# returned and response bytes, aggregated per route for /metrics
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', '1000'))
+SLOW_REQUEST_MAX_QUERY_SHAPES = 20
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def query_shape(value: Any) -> Any:
+    """A filter or pipeline with its literal values replaced by placeholders"""
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, list) and value and all(isinstance(item, dict) for item in value):
+        return [query_shape(item) for item in value]
+    return "?"
+
+def command_shape(command_name: str, command: dict) -> Optional[str]:
+    """Short description of a read or write command's filter, for slow request logs"""
+    collection = command.get(command_name)
+    if not isinstance(collection, str):
+        return None
+    for key in ("filter", "pipeline", "query"):
+        if key in command:
+            return f"{command_name} {collection} {json.dumps(query_shape(command[key]))}"
+    for key in ("updates", "deletes"):
+        if command.get(key):
+            return f"{command_name} {collection} {json.dumps(query_shape(command[key][0].get('q', {})))}"
+    return f"{command_name} {collection}"
+
+class RequestMetrics:
+    """Mongo activity attributed to one request; updated from Motor's executor threads"""
+    def __init__(self):
+        self.db_commands = 0
+        self.db_seconds = 0.0
+        self.documents_returned = 0
+        self.query_shapes: List[str] = []
+        self._lock = threading.Lock()
+    
+    def record_command(self, duration_seconds: float, documents: int, shape: Optional[str]):
+        with self._lock:
+            self.db_commands += 1
+            self.db_seconds += duration_seconds
+            self.documents_returned += documents
+            if shape and len(self.query_shapes) < SLOW_REQUEST_MAX_QUERY_SHAPES:
+                self.query_shapes.append(shape)
+
+current_request_metrics: ContextVar[Optional[RequestMetrics]] = ContextVar("current_request_metrics", default=None)
+
+class CommandMetricsListener(monitoring.CommandListener):
+    """Attributes Mongo commands to the current request; Motor copies the request's context into its threads"""
+    def __init__(self):
+        self._shapes: Dict[int, Optional[str]] = {}
+    
+    def started(self, event):
+        if current_request_metrics.get() is not None and SLOW_REQUEST_MS:
+            self._shapes[event.request_id] = command_shape(event.command_name, event.command)
+    
+    def _finish(self, event, documents: int):
+        shape = self._shapes.pop(event.request_id, None)
+        metrics = current_request_metrics.get()
+        if metrics is not None:
+            metrics.record_command(event.duration_micros / 1e6, documents, shape)
+    
+    def succeeded(self, event):
+        reply = event.reply or {}
+        cursor = reply.get("cursor") or {}
+        batch = cursor.get("firstBatch", cursor.get("nextBatch"))
+        if batch is not None:
+            documents = len(batch)
+        else:
+            documents = 1 if reply.get("value") else 0
+        self._finish(event, documents)
+    
+    def failed(self, event):
+        self._finish(event, 0)
+
+class RouteMetrics:
+    """Per-route counters and latency histograms, rendered in the Prometheus text format"""
+    def __init__(self):
+        self._routes: Dict[tuple, dict] = {}
+    
+    def observe(self, method: str, route: str, status: int, seconds: float, response_bytes: int, metrics: RequestMetrics):
+        stats = self._routes.setdefault((method, route), {
+            "statuses": {}, "buckets": [0] * len(LATENCY_BUCKETS), "count": 0, "seconds": 0.0,
+            "db_commands": 0, "db_seconds": 0.0, "documents_returned": 0, "response_bytes": 0
+        })
+        stats["statuses"][status] = stats["statuses"].get(status, 0) + 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                stats["buckets"][i] += 1
+        stats["count"] += 1
+        stats["seconds"] += seconds
+        stats["db_commands"] += metrics.db_commands
+        stats["db_seconds"] += metrics.db_seconds
+        stats["documents_returned"] += metrics.documents_returned
+        stats["response_bytes"] += response_bytes
+    
+    def render(self) -> str:
+        lines = [
+            "# HELP http_requests_total Requests by route and status.",
+            "# TYPE http_requests_total counter"
+        ]
+        for (method, route), stats in self._routes.items():
+            for status, count in stats["statuses"].items():
+                lines.append(f'http_requests_total{{method="{method}",route="{route}",status="{status}"}} {count}')
+        
+        lines += [
+            "# HELP http_request_duration_seconds Request latency by route.",
+            "# TYPE http_request_duration_seconds histogram"
+        ]
+        for (method, route), stats in self._routes.items():
+            labels = f'method="{method}",route="{route}"'
+            for bound, count in zip(LATENCY_BUCKETS, stats["buckets"]):
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {stats["count"]}')
+            lines.append(f'http_request_duration_seconds_sum{{{labels}}} {stats["seconds"]:.6f}')
+            lines.append(f'http_request_duration_seconds_count{{{labels}}} {stats["count"]}')
+        
+        for name, key, help_text in [
+            ("http_request_db_commands_total", "db_commands", "Mongo commands issued while serving the route."),
+            ("http_request_db_seconds_total", "db_seconds", "Time spent in Mongo commands while serving the route."),
+            ("http_request_db_documents_returned_total", "documents_returned", "Documents returned by Mongo to the route."),
+            ("http_response_bytes_total", "response_bytes", "Response body bytes sent by the route.")
+        ]:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            for (method, route), stats in self._routes.items():
+                value = stats[key]
+                lines.append(f'{name}{{method="{method}",route="{route}"}} {value:.6f}' if isinstance(value, float)
+                             else f'{name}{{method="{method}",route="{route}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+route_metrics = RouteMetrics()
+
+class RequestMetricsMiddleware:
+    """Pure ASGI middleware timing each request and recording it against its route template"""
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        metrics = RequestMetrics()
+        token = current_request_metrics.set(metrics)
+        status = 500
+        response_bytes = 0
+        
+        async def send_with_metrics(message):
+            nonlocal status, response_bytes
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                response_bytes += len(message.get("body", b""))
+            await send(message)
+        
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            seconds = time.perf_counter() - start
+            current_request_metrics.reset(token)
+            route = scope.get("route")
+            route_path = getattr(route, "path", None) or "unmatched"
+            if route_path != "/metrics":
+                route_metrics.observe(scope["method"], route_path, status, seconds, response_bytes, metrics)
+            if SLOW_REQUEST_MS and seconds * 1000 >= SLOW_REQUEST_MS:
+                logger.warning(
+                    f"Slow request {scope['method']} {route_path} {status} {seconds * 1000:.0f}ms: "
+                    f"{metrics.db_commands} db commands in {metrics.db_seconds * 1000:.0f}ms, "
+                    f"{metrics.documents_returned} documents, {response_bytes} bytes; "
+                    f"queries: {'; '.join(metrics.query_shapes) or 'none'}"
+                )
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[CommandMetricsListener()])
 db = client[os.environ['DB_NAME']]
 
+# Index registry: every index the routes rely on, created at startup
+# Funnel event storage: optionally a time-series collection, with optional retention
+FUNNEL_EVENTS_TIMESERIES = os.environ.get('FUNNEL_EVENTS_TIMESERIES', 'false').lower() == 'true'
+FUNNEL_EVENTS_RETENTION_SECONDS = int(float(os.environ.get('FUNNEL_EVENTS_RETENTION_DAYS', '0')) * 86400)
+FUNNEL_EVENTS_ARCHIVE_DIR = os.environ.get('FUNNEL_EVENTS_ARCHIVE_DIR')
+
+INDEX_REGISTRY: Dict[str, List[IndexModel]] = {
+    "physical_units": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)]),
+    ],
+    "virtual_units": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("physical_unit_id", ASCENDING)]),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("unit_type", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)]),
+    ],
+    "bookings": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("physical_unit_id", ASCENDING), ("status", ASCENDING), ("start_date", ASCENDING)]),
+        IndexModel([("status", ASCENDING), ("end_date", ASCENDING), ("start_date", ASCENDING)]),
+        IndexModel([("customer_email", ASCENDING), ("customer_id", ASCENDING)]),
+        IndexModel([("customer_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)]),
+    ],
+    "image_assets": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("category", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("tags", ASCENDING)]),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)]),
+    ],
+    "filter_facets": [
+        IndexModel([("id", ASCENDING)], unique=True),
+    ],
+    "content_blocks": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("key", ASCENDING)]),
+        IndexModel([("section", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)]),
+    ],
+    "promo_banners": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("is_active", ASCENDING)]),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)]),
+    ],
+    "funnel_events": [
+        IndexModel([("session_id", ASCENDING), ("timestamp", DESCENDING)]),
+        IndexModel([("timestamp", ASCENDING)]),
+        # Doubles as the retention TTL when funnel_events is a plain collection, so events
+        # expire by the same ingest time the archiver groups them by
+        IndexModel([("ingested_at", ASCENDING)], **(
+            {"expireAfterSeconds": FUNNEL_EVENTS_RETENTION_SECONDS}
+            if FUNNEL_EVENTS_RETENTION_SECONDS and not FUNNEL_EVENTS_TIMESERIES else {}
+        )),
+        # Events stored while a rollup rebuild deferred their counts
+        IndexModel([("rollup_pending", ASCENDING)], partialFilterExpression={"rollup_pending": True}),
+    ],
+    "funnel_sessions": [
+        IndexModel([("session_id", ASCENDING)], unique=True),
+        # A session idle for a day has no events left in the stage window
+        IndexModel([("last_activity", ASCENDING)], expireAfterSeconds=86400),
+    ],
+    "funnel_archives": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("end", DESCENDING)]),
+    ],
+    "api_keys": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("service", ASCENDING), ("key_name", ASCENDING), ("is_active", ASCENDING)]),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)]),
+    ],
+    "payment_transactions": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("stripe_session_id", ASCENDING)]),
+    ],
+    "customers": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("email", ASCENDING)]),
+        IndexModel([("customer_type", ASCENDING)]),
+        IndexModel([("loyalty_tier", ASCENDING)]),
+        IndexModel([("tags", ASCENDING)]),
+        IndexModel([("search_tokens", ASCENDING)]),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("marketing_consent", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)]),
+    ],
+    "locations": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("is_active", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)]),
+    ],
+    "loyalty_transactions": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("customer_id", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel(
+            [("idempotency_key", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"idempotency_key": {"$type": "string"}}
+        ),
+    ],
+    "referrals": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("referred_email", ASCENDING)]),
+        IndexModel([("referrer_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)]),
+    ],
+    "brand_settings": [
+        IndexModel([("location_id", ASCENDING)]),
+    ],
+    "push_subscriptions": [
+        IndexModel([("endpoint", ASCENDING)]),
+        IndexModel([("customer_id", ASCENDING)]),
+    ],
+    "unit_holds": [
+        IndexModel([("hold_id", ASCENDING)], unique=True),
+        IndexModel([("physical_unit_id", ASCENDING), ("expires_at", ASCENDING)]),
+        # Expired holds are already free; this only garbage-collects them
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+    "funnel_rollups": [
+        IndexModel([("granularity", ASCENDING), ("bucket", ASCENDING), ("location_id", ASCENDING)], unique=True),
+    ],
+    "notification_templates": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("trigger", ASCENDING), ("template_type", ASCENDING), ("is_active", ASCENDING)]),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)]),
+    ],
+    "notification_campaigns": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("status", ASCENDING), ("heartbeat_at", ASCENDING)]),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)]),
+    ],
+    "notification_outbox": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("channel", ASCENDING), ("status", ASCENDING), ("next_attempt_at", ASCENDING)]),
+        IndexModel([("claim_id", ASCENDING)]),
+    ],
+}
+
+async def ensure_indexes():
+    """Create missing indexes from INDEX_REGISTRY (existing indexes are left untouched)"""
+    for collection_name, indexes in INDEX_REGISTRY.items():
+        for index in indexes:
+            try:
+                await db[collection_name].create_indexes([index])
+            except OperationFailure as e:
+                logger.warning(f"Could not create index {index.document['name']} on {collection_name}: {e}")
+
+async def configure_funnel_events_collection():
+    """Create funnel_events as a time-series collection and keep its retention in sync with config"""
+    existing = await db.list_collection_names(filter={"name": "funnel_events"})
+    if not existing and FUNNEL_EVENTS_TIMESERIES:
+        options = {"timeseries": {"timeField": "ingested_at", "metaField": "session_id", "granularity": "seconds"}}
+        if FUNNEL_EVENTS_RETENTION_SECONDS:
+            options["expireAfterSeconds"] = FUNNEL_EVENTS_RETENTION_SECONDS
+        await db.create_collection("funnel_events", **options)
+        return
+    
+    info = await db.funnel_events.options() if existing else {}
+    if FUNNEL_EVENTS_TIMESERIES and "timeseries" not in info:
+        logger.warning("FUNNEL_EVENTS_TIMESERIES is set but funnel_events is a plain collection; "
+                       "archive and drop it to convert")
+    if not existing:
+        return
+    try:
+        if "timeseries" in info:
+            if FUNNEL_EVENTS_RETENTION_SECONDS:
+                await db.command("collMod", "funnel_events", expireAfterSeconds=FUNNEL_EVENTS_RETENTION_SECONDS)
+            return
+        # Retention moved from the client timestamp to ingested_at; drop the old TTL index
+        # so ensure_indexes recreates it as a plain index
+        async for index in db.funnel_events.list_indexes():
+            if dict(index["key"]) == {"timestamp": 1} and "expireAfterSeconds" in index:
+                await db.funnel_events.drop_index(index["name"])
+        if FUNNEL_EVENTS_RETENTION_SECONDS:
+            # create_indexes leaves an existing ingested_at index as is, so update its TTL in place
+            await db.command("collMod", "funnel_events", index={
+                "keyPattern": {"ingested_at": 1}, "expireAfterSeconds": FUNNEL_EVENTS_RETENTION_SECONDS
+            })
+    except OperationFailure as e:
+        logger.warning(f"Could not apply funnel_events retention: {e}")
+
+async def funnel_events_time_field() -> str:
+    """Field funnel events expire and are archived by: the time-series timeField, else ingested_at"""
+    info = await db.funnel_events.options()
+    return info.get("timeseries", {}).get("timeField", "ingested_at")
+
+async def backfill_funnel_event_ingested_at():
+    """Give events stored before ingested_at existed their timestamp, so they expire and archive by it"""
+    if "timeseries" in await db.funnel_events.options():
+        return
+    await db.funnel_events.update_many(
+        {"ingested_at": {"$exists": False}}, [{"$set": {"ingested_at": "$timestamp"}}]
+    )
+
+async def run_migration(name: str, migration):
+    """Run an idempotent data migration once, recording it in db.migrations"""
+    if await db.migrations.find_one({"id": name}):
+        return
+    logger.info(f"Running migration {name}")
+    await migration()
+    await db.migrations.update_one(
+        {"id": name}, {"$set": {"applied_at": datetime.utcnow()}}, upsert=True
+    )
+
+async def acquire_lease(name: str, owner: str, seconds: float) -> bool:
+    """Take a named lease in db.job_leases unless another owner holds an unexpired one"""
+    now = datetime.utcnow()
+    try:
+        await db.job_leases.update_one(
+            {"_id": name, "expires_at": {"$lte": now}},
+            {"$set": {"owner": owner, "acquired_at": now, "expires_at": now + timedelta(seconds=seconds)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+async def renew_lease(name: str, owner: str, seconds: float) -> bool:
+    """Extend a lease this owner still holds; False once it has been taken over"""
+    result = await db.job_leases.update_one(
+        {"_id": name, "owner": owner},
+        {"$set": {"expires_at": datetime.utcnow() + timedelta(seconds=seconds)}}
+    )
+    return result.matched_count == 1
+
+async def release_lease(name: str, owner: str):
+    await db.job_leases.delete_one({"_id": name, "owner": owner})
+
+async def get_index_usage_report() -> Dict[str, Any]:
+    """Report per-index usage counters, unused indexes and indexes missing from the registry"""
+    report = {}
+    for collection_name, indexes in INDEX_REGISTRY.items():
+        declared = {index.document["name"] for index in indexes}
+        stats = await db[collection_name].aggregate([{"$indexStats": {}}]).to_list(None)
+        usage = {stat["name"]: stat["accesses"]["ops"] for stat in stats}
+        report[collection_name] = {
+            "usage": usage,
+            "missing": sorted(declared - set(usage)),
+            "unused": sorted(name for name, ops in usage.items() if ops == 0 and name != "_id_"),
+            "undeclared": sorted(name for name in usage if name not in declared and name != "_id_")
+        }
+    return report
+
+# Integration credentials cache
+class CredentialsCache:
+    """In-process cache of active API keys, refreshed after a TTL or on invalidation"""
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._credentials: Optional[Dict[tuple, str]] = None
+        self._loaded_at = 0.0
+        self._generation = 0
+        self._lock = asyncio.Lock()
+    
+    def invalidate(self):
+        self._generation += 1
+        self._credentials = None
+    
+    def _is_fresh(self) -> bool:
+        return self._credentials is not None and time.monotonic() - self._loaded_at < self.ttl_seconds
+    
+    async def get_all(self) -> Dict[tuple, str]:
+        if self._is_fresh():
+            return self._credentials
+        async with self._lock:
+            if self._is_fresh():
+                return self._credentials
+            generation = self._generation
+            api_keys = await db.api_keys.find(
+                {"is_active": True},
+                {"_id": 0, "service": 1, "key_name": 1, "key_value": 1}
+            ).to_list(None)
+            credentials = {(key["service"], key["key_name"]): key["key_value"] for key in api_keys}
+            # Keys changed while loading: serve this result but reload next time
+            if generation == self._generation:
+                self._credentials = credentials
+                self._loaded_at = time.monotonic()
+            return credentials
+    
+    async def get(self, service: str, key_name: str) -> Optional[str]:
+        return (await self.get_all()).get((service, key_name))
+
+credentials_cache = CredentialsCache(float(os.environ.get('CREDENTIALS_CACHE_TTL_SECONDS', '300')))
+
+# Credentials each service client was last built with
+configured_credentials: Dict[str, tuple] = {}
+
 # Helper function to get configured services
 async def get_api_key(service: str, key_name: str) -> Optional[str]:
-    """Get API key from database"""
+    """Get API key from the credentials cache"""
     try:
-        api_key = await db.api_keys.find_one({
-            "service": service,
-            "key_name": key_name,
-            "is_active": True
-        })
-        return api_key["key_value"] if api_key else None
-    except:
+        return await credentials_cache.get(service, key_name)
+    except Exception:
         return None
 
 async def configure_services():
-    """Configure services with API keys from database"""
+    """Configure services with cached API keys, rebuilding only clients whose keys changed"""
     global stripe_service, twilio_service, email_service
     
+    try:
+        credentials = await credentials_cache.get_all()
+    except PyMongoError as e:
+        logger.error(f"Could not load API keys: {e}")
+        return
+    
     # Configure Stripe
-    stripe_key = await get_api_key("stripe", "secret_key")
-    if stripe_key:
+    stripe_config = (credentials.get(("stripe", "secret_key")),)
+    if configured_credentials.get("stripe") != stripe_config:
+        stripe_key, = stripe_config
+        if not stripe_key:
+            stripe.api_key = None
         stripe_service = StripeService(stripe_key)
+        configured_credentials["stripe"] = stripe_config
     
     # Configure Twilio
-    twilio_sid = await get_api_key("twilio", "account_sid")
-    twilio_token = await get_api_key("twilio", "auth_token")
-    twilio_number = await get_api_key("twilio", "from_number")
-    if twilio_sid and twilio_token and twilio_number:
-        twilio_service = TwilioService(twilio_sid, twilio_token, twilio_number)
+    twilio_config = (
+        credentials.get(("twilio", "account_sid")),
+        credentials.get(("twilio", "auth_token")),
+        credentials.get(("twilio", "from_number"))
+    )
+    if configured_credentials.get("twilio") != twilio_config:
+        twilio_service = TwilioService(*twilio_config) if all(twilio_config) else TwilioService()
+        configured_credentials["twilio"] = twilio_config
     
     # Configure Email
-    email_key = await get_api_key("sendgrid", "api_key")
-    from_email = await get_api_key("sendgrid", "from_email")
-    if email_key and from_email:
-        email_service = EmailService(email_key, from_email)
+    email_config = (
+        credentials.get(("sendgrid", "api_key")),
+        credentials.get(("sendgrid", "from_email"))
+    )
+    if configured_credentials.get("sendgrid") != email_config:
+        email_service = EmailService(*email_config) if all(email_config) else EmailService()
+        configured_credentials["sendgrid"] = email_config
+
+async def watch_api_key_changes():
+    """Refresh credentials whenever api_keys changes, including writes from other workers"""
+    while True:
+        try:
+            async with db.api_keys.watch() as stream:
+                async for _ in stream:
+                    credentials_cache.invalidate()
+                    await configure_services()
+        except OperationFailure as e:
+            # Standalone servers have no change streams; the cache TTL still applies
+            logger.info(f"api_keys change stream unavailable, relying on cache TTL: {e}")
+            return
+        except PyMongoError as e:
+            logger.warning(f"api_keys change stream interrupted: {e}")
+            credentials_cache.invalidate()
+            await asyncio.sleep(5)
+
+# Long-running tasks started with the app and cancelled on shutdown
+background_tasks: List[asyncio.Task] = []
 
 # Create the main app without a prefix
 app = FastAPI(title="RV & Boat Storage Management System", version="1.0.0")
@@ -377,6 +1024,7 @@ class Booking(BaseModel):
     status: BookingStatus = BookingStatus.BOOKED
     move_in_date: Optional[datetime] = None
     special_requests: Optional[str] = None
+    customer_id: Optional[str] = None  # CRM customer with the booking's email, if any
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 class FilterOptions(BaseModel):
@@ -440,6 +1088,10 @@ class LoyaltyTransaction(BaseModel):
     description: str
     booking_id: Optional[str] = None
     referral_id: Optional[str] = None
+    idempotency_key: Optional[str] = None  # client-supplied key making retries safe
+    status: str = "applied"  # pending, applied, rejected
+    balance_after: Optional[int] = None
+    tier_after: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 class Referral(BaseModel):
@@ -493,7 +1145,9 @@ class NotificationTemplate(BaseModel):
     variables: List[str] = []  # list of template variables like {customer_name}
     trigger: str  # booking_confirmed, payment_received, etc.
     is_active: bool = True
+    version: int = 1  # bumped on every update to invalidate compiled copies
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
 
 class APIKey(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -528,6 +1182,50 @@ class PaymentTransaction(BaseModel):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
+class NotificationOutboxItem(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    channel: str  # sms, email
+    recipient: str  # phone number or email address
+    subject: Optional[str] = None
+    content: str  # rendered SMS text or email HTML
+    status: str = "pending"  # pending, processing, sent, dead
+    attempts: int = 0
+    max_attempts: int = 5
+    last_error: Optional[str] = None
+    next_attempt_at: datetime = Field(default_factory=datetime.utcnow)
+    claim_id: Optional[str] = None
+    locked_until: Optional[datetime] = None
+    sent_at: Optional[datetime] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+class CampaignAudience(BaseModel):
+    loyalty_tiers: Optional[List[str]] = None
+    tags: Optional[List[str]] = None
+    customer_types: Optional[List[str]] = None
+    marketing_consent: bool = True  # only customers who opted in
+
+class NotificationCampaign(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    name: str
+    channel: str  # email, sms
+    subject: Optional[str] = None
+    content: Optional[str] = None  # Jinja template over customer fields, e.g. {{ first_name }}
+    template_id: Optional[str] = None  # NotificationTemplate used instead of subject/content
+    audience: CampaignAudience = Field(default_factory=CampaignAudience)
+    status: str = "queued"  # queued, running, completed, failed
+    total_recipients: int = 0
+    sent: int = 0
+    failed: int = 0
+    messages_per_second: Optional[float] = None
+    last_error: Optional[str] = None
+    cursor: Optional[str] = None  # position of the last customer processed
+    heartbeat_at: Optional[datetime] = None
+    lease_owner: Optional[str] = None  # worker run holding the campaign while it is running
+    started_at: Optional[datetime] = None
+    completed_at: Optional[datetime] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
 class ContentBlock(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     key: str  # e.g., "hero_title", "hero_subtitle", "feature_1_title"
@@ -573,14 +1271,14 @@ class BookingRequest(BaseModel):
     end_date: Optional[datetime] = None
     move_in_date: Optional[datetime] = None
     special_requests: Optional[str] = None
+    hold_id: Optional[str] = None  # checkout hold from POST /bookings/holds
 
 # Helper functions
 def get_size_category(size: str) -> str:
     """Categorize unit size as small, medium, or large"""
     try:
-        dimensions = size.lower().replace('x', '').replace(' ', '')
-        # Extract numbers from size string
-        numbers = [int(s) for s in dimensions.split() if s.isdigit()]
+        # Extract the two dimensions from a size string like "12x30"
+        numbers = [int(s.strip()) for s in size.lower().split('x')[:2]]
         if len(numbers) >= 2:
             area = numbers[0] * numbers[1]
             if area <= 200:
@@ -602,6 +1300,118 @@ def get_price_for_period(virtual_unit: VirtualUnit, period: PricingPeriod) -> fl
     else:
         return virtual_unit.monthly_price
 
+def size_category_expression(field: str) -> dict:
+    """Aggregation expression mirroring get_size_category for a size string field"""
+    dimensions = {"$split": [{"$toLower": field}, "x"]}
+
+    def dimension(index: int) -> dict:
+        return {"$convert": {
+            "input": {"$trim": {"input": {"$arrayElemAt": [dimensions, index]}}},
+            "to": "int",
+            "onError": None,
+            "onNull": None
+        }}
+
+    area = {"$multiply": [dimension(0), dimension(1)]}
+    return {"$let": {
+        "vars": {"area": area},
+        "in": {"$switch": {
+            "branches": [
+                {"case": {"$eq": ["$$area", None]}, "then": "medium"},
+                {"case": {"$lte": ["$$area", 200]}, "then": "small"},
+                {"case": {"$lte": ["$$area", 400]}, "then": "medium"}
+            ],
+            "default": "large"
+        }}
+    }}
+
+# Cursor pagination helpers
+DEFAULT_PAGE_SORT = [("created_at", 1), ("id", 1)]
+NEWEST_FIRST_SORT = [("created_at", -1), ("id", -1)]
+
+def encode_cursor(document: dict, sort: List[tuple] = DEFAULT_PAGE_SORT) -> str:
+    """Build an opaque cursor from the sort keys of the last document in a page"""
+    values = {field: document.get(field) for field, _ in sort}
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode()).decode()
+
+def decode_cursor(cursor: str) -> dict:
+    """Decode an opaque cursor produced by encode_cursor"""
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, dict):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def keyset_filter(cursor: str, sort: List[tuple] = DEFAULT_PAGE_SORT) -> dict:
+    """Filter matching documents strictly after the cursor position for the given sort"""
+    values = decode_cursor(cursor)
+    clauses = []
+    for i, (field, direction) in enumerate(sort):
+        clause = {prev: values.get(prev) for prev, _ in sort[:i]}
+        clause[field] = {"$gt" if direction > 0 else "$lt": values.get(field)}
+        clauses.append(clause)
+    return {"$or": clauses}
+
+async def paginate_find(
+    collection,
+    query: dict,
+    response: Response,
+    limit: int,
+    cursor: Optional[str] = None,
+    sort: List[tuple] = DEFAULT_PAGE_SORT,
+    projection: Optional[dict] = None
+) -> List[dict]:
+    """Fetch one page of a keyset-paginated query, setting X-Next-Cursor when more remain"""
+    if cursor:
+        query = {"$and": [query, keyset_filter(cursor, sort)]} if query else keyset_filter(cursor, sort)
+    documents = await collection.find(query, projection or {"_id": 0}).sort(sort).limit(limit + 1).to_list(limit + 1)
+    if len(documents) > limit:
+        documents = documents[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(documents[-1], sort)
+    return documents
+
+# HTTP caching helpers
+def make_etag(body: bytes) -> str:
+    """Strong ETag for a serialized response body"""
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+def cached_json_response(
+    request: Request, body: bytes, etag: str, cache_control: str = "public, no-cache", extra_headers: Optional[dict] = None
+) -> Response:
+    """Serve a pre-serialized JSON body, or 304 when the client already holds this version"""
+    headers = {"ETag": etag, "Cache-Control": cache_control, **(extra_headers or {})}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+class ReadThroughCache:
+    """Serialized responses with ETags, loaded on first read and dropped on invalidate or after ttl"""
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._entries: Dict[Any, tuple] = {}
+        self._generation = 0
+    
+    def invalidate(self):
+        self._generation += 1
+        self._entries.clear()
+    
+    async def get(self, key: Any, loader) -> tuple:
+        """Serialized body, ETag and extra headers for key; loader() returns the body, or (body, headers), on a miss"""
+        entry = self._entries.get(key)
+        if entry and time.monotonic() < entry[3]:
+            return entry[:3]
+        generation = self._generation
+        loaded = await loader()
+        body, headers = loaded if isinstance(loaded, tuple) else (loaded, {})
+        etag = make_etag(body)
+        # Don't cache a body loaded across a write
+        if generation == self._generation:
+            self._entries[key] = (body, etag, headers, time.monotonic() + self.ttl_seconds)
+        return body, etag, headers
+
 # API Routes
 
 @api_router.get("/")
@@ -616,9 +1426,9 @@ async def create_physical_unit(unit: PhysicalUnit):
     return unit
 
 @api_router.get("/physical-units", response_model=List[PhysicalUnit])
-async def get_physical_units():
-    """Get all physical units"""
-    units = await db.physical_units.find().to_list(1000)
+async def get_physical_units(response: Response, limit: int = Query(1000, ge=1, le=1000), cursor: Optional[str] = None):
+    """Get physical units (next page cursor in X-Next-Cursor header)"""
+    units = await paginate_find(db.physical_units, {}, response, limit, cursor)
     return [PhysicalUnit(**unit) for unit in units]
 
 @api_router.post("/virtual-units", response_model=VirtualUnit)
@@ -631,63 +1441,372 @@ async def create_virtual_unit(unit: VirtualUnit):
     
     unit_dict = unit.dict()
     await db.virtual_units.insert_one(unit_dict)
+    await refresh_filter_facets()
     return unit
 
-@api_router.get("/virtual-units", response_model=List[VirtualUnit])
-async def get_virtual_units(
+# Bulk import and export: NDJSON or CSV bodies are parsed as they stream in and
+# written in batches; list fields are ";"-separated in CSV
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', '500'))
+IMPORT_MAX_REPORTED_ERRORS = 1000
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '1000'))
+BULK_FORMAT_PATTERN = "^(ndjson|csv)$"
+LIST_FIELD_SEPARATOR = ";"
+
+async def iter_request_lines(request: Request):
+    """Decoded lines of a streamed request body"""
+    buffer = b""
+    first = True
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            text = line.decode("utf-8").rstrip("\r")
+            yield text.lstrip("\ufeff") if first else text
+            first = False
+    if buffer:
+        text = buffer.decode("utf-8").rstrip("\r")
+        yield text.lstrip("\ufeff") if first else text
+
+async def iter_import_rows(request: Request, file_format: str):
+    """Yield (row_number, row, error) for each record of an NDJSON or CSV body"""
+    row_number = 0
+    if file_format == "ndjson":
+        async for line in iter_request_lines(request):
+            if not line.strip():
+                continue
+            row_number += 1
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield row_number, None, f"Invalid JSON: {e}"
+                continue
+            if isinstance(row, dict):
+                yield row_number, row, None
+            else:
+                yield row_number, None, "Expected a JSON object"
+        return
+    
+    header = None
+    pending = ""
+    async for line in iter_request_lines(request):
+        pending = f"{pending}\n{line}" if pending else line
+        # A quoted field may contain newlines; wait until its quotes are balanced
+        if pending.count('"') % 2:
+            continue
+        record, pending = next(csv.reader([pending])) if pending else [], ""
+        if not record:
+            continue
+        if header is None:
+            header = [column.strip() for column in record]
+            continue
+        row_number += 1
+        yield row_number, {column: value for column, value in zip(header, record) if value != ""}, None
+    if pending:
+        yield row_number + 1, None, "Unterminated quoted field"
+
+def record_import_error(summary: dict, row_number: int, message: str):
+    summary["error_count"] += 1
+    if len(summary["errors"]) < IMPORT_MAX_REPORTED_ERRORS:
+        summary["errors"].append({"row": row_number, "error": message})
+
+async def write_import_batch(batch: List[tuple], model, collection, list_fields: List[str], summary: dict, resolve_batch=None):
+    """Validate a batch of rows and upsert the valid ones by id in one unordered bulk write"""
+    if resolve_batch:
+        batch = await resolve_batch(batch, summary)
+    
+    row_numbers = []
+    operations = []
+    for row_number, row in batch:
+        for field in list_fields:
+            if isinstance(row.get(field), str):
+                row[field] = [item.strip() for item in row[field].split(LIST_FIELD_SEPARATOR) if item.strip()]
+        try:
+            document = model(**row).dict()
+        except ValidationError as e:
+            record_import_error(summary, row_number, "; ".join(
+                f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in e.errors()
+            ))
+            continue
+        row_numbers.append(row_number)
+        operations.append(ReplaceOne({"id": document["id"]}, document, upsert=True))
+    
+    if not operations:
+        return
+    try:
+        result = await collection.bulk_write(operations, ordered=False)
+        summary["created"] += result.upserted_count
+        summary["updated"] += result.matched_count
+    except BulkWriteError as e:
+        summary["created"] += e.details.get("nUpserted", 0)
+        summary["updated"] += e.details.get("nMatched", 0)
+        for error in e.details.get("writeErrors", []):
+            record_import_error(summary, row_numbers[error["index"]], error.get("errmsg", "Write failed"))
+
+async def import_documents(request: Request, file_format: str, model, collection, list_fields: List[str], resolve_batch=None) -> dict:
+    """Stream rows from the request body into collection in batches, collecting per-row errors"""
+    summary = {"processed": 0, "created": 0, "updated": 0, "error_count": 0, "errors": []}
+    batch = []
+    async for row_number, row, error in iter_import_rows(request, file_format):
+        summary["processed"] += 1
+        if error:
+            record_import_error(summary, row_number, error)
+            continue
+        batch.append((row_number, row))
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            await write_import_batch(batch, model, collection, list_fields, summary, resolve_batch)
+            batch = []
+    if batch:
+        await write_import_batch(batch, model, collection, list_fields, summary, resolve_batch)
+    return summary
+
+async def resolve_physical_unit_refs(batch: List[tuple], summary: dict) -> List[tuple]:
+    """Resolve each row's physical_unit_id, given as an id or a unit number, with one query per batch"""
+    refs = list({row["physical_unit_id"] for _, row in batch if row.get("physical_unit_id")})
+    ids = set()
+    ids_by_number: Dict[str, List[str]] = {}
+    async for unit in db.physical_units.find(
+        {"$or": [{"id": {"$in": refs}}, {"unit_number": {"$in": refs}}]}, {"_id": 0, "id": 1, "unit_number": 1}
+    ):
+        ids.add(unit["id"])
+        ids_by_number.setdefault(unit["unit_number"], []).append(unit["id"])
+    
+    resolved = []
+    for row_number, row in batch:
+        ref = row.get("physical_unit_id")
+        if ref and ref not in ids:
+            matches = ids_by_number.get(ref, [])
+            if not matches:
+                record_import_error(summary, row_number, f"Physical unit not found: {ref}")
+                continue
+            if len(matches) > 1:
+                record_import_error(summary, row_number, f"Unit number {ref} matches {len(matches)} physical units; use the id")
+                continue
+            row["physical_unit_id"] = matches[0]
+        resolved.append((row_number, row))
+    return resolved
+
+def export_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Enum):
+        return value.value
+    return value
+
+def csv_export_value(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        return LIST_FIELD_SEPARATOR.join(str(export_value(item)) for item in value)
+    if isinstance(value, dict):
+        return json.dumps(value, default=export_value)
+    return str(export_value(value))
+
+async def stream_export(cursor, file_format: str, fields: Optional[List[str]] = None, chunk_rows: int = EXPORT_BATCH_SIZE):
+    """Serialize documents from a cursor as NDJSON or CSV, a batch of rows per chunk"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    rows = 0
+    async for document in cursor:
+        if file_format == "ndjson":
+            buffer.write(json.dumps(document, default=export_value) + "\n")
+        else:
+            if fields is None:
+                fields = list(document.keys())
+            if rows == 0:
+                writer.writerow(fields)
+            writer.writerow([csv_export_value(document.get(field)) for field in fields])
+        rows += 1
+        if rows % chunk_rows == 0:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    if file_format == "csv" and rows == 0 and fields:
+        writer.writerow(fields)
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+def export_response(
+    cursor, file_format: str, filename: str, fields: Optional[List[str]] = None, chunk_rows: int = EXPORT_BATCH_SIZE
+) -> StreamingResponse:
+    media_type = "application/x-ndjson" if file_format == "ndjson" else "text/csv"
+    return StreamingResponse(
+        stream_export(cursor, file_format, fields, chunk_rows),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{file_format}"'}
+    )
+
+def export_fields(fields: Optional[str], model) -> List[str]:
+    """Requested export columns, validated against the model's fields"""
+    available = list(model.model_fields)
+    if not fields:
+        return available
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in available]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return requested
+
+def export_cursor(collection, query: dict, fields: List[str], sort: List[tuple], batch_size: int):
+    """Cursor over only the exported fields, fetched in batches of batch_size"""
+    projection = {"_id": 0, **{field: 1 for field in fields}}
+    return collection.find(query, projection).sort(sort).batch_size(batch_size)
+
+def date_range_filter(field: str, start_date: Optional[datetime], end_date: Optional[datetime]) -> dict:
+    """Filter on field within [start_date, end_date)"""
+    date_range = {}
+    if start_date:
+        date_range["$gte"] = to_utc_naive(start_date)
+    if end_date:
+        date_range["$lt"] = to_utc_naive(end_date)
+    return {field: date_range} if date_range else {}
+
+@api_router.post("/physical-units/import")
+async def import_physical_units(request: Request, file_format: str = Query("ndjson", alias="format", pattern=BULK_FORMAT_PATTERN)):
+    """Bulk import physical units; rows with the id of an existing unit replace it"""
+    return await import_documents(request, file_format, PhysicalUnit, db.physical_units, ["amenities"])
+
+@api_router.get("/physical-units/export")
+async def export_physical_units(file_format: str = Query("ndjson", alias="format", pattern=BULK_FORMAT_PATTERN)):
+    """Stream all physical units as NDJSON or CSV"""
+    cursor = db.physical_units.find({}, {"_id": 0}).batch_size(EXPORT_BATCH_SIZE)
+    return export_response(cursor, file_format, "physical_units", list(PhysicalUnit.model_fields))
+
+@api_router.post("/virtual-units/import")
+async def import_virtual_units(request: Request, file_format: str = Query("ndjson", alias="format", pattern=BULK_FORMAT_PATTERN)):
+    """Bulk import virtual units; physical_unit_id may be a physical unit id or unit number"""
+    summary = await import_documents(
+        request, file_format, VirtualUnit, db.virtual_units, ["amenities"], resolve_physical_unit_refs
+    )
+    if summary["created"] or summary["updated"]:
+        await refresh_filter_facets()
+    return summary
+
+@api_router.get("/virtual-units/export")
+async def export_virtual_units(file_format: str = Query("ndjson", alias="format", pattern=BULK_FORMAT_PATTERN)):
+    """Stream all virtual units as NDJSON or CSV"""
+    cursor = db.virtual_units.find({}, {"_id": 0}).batch_size(EXPORT_BATCH_SIZE)
+    return export_response(cursor, file_format, "virtual_units", list(VirtualUnit.model_fields))
+
+# Availability: a booking occupies its physical unit over [start_date, end_date),
+# open-ended when end_date is missing
+ACTIVE_BOOKING_STATUSES = [BookingStatus.BOOKED, BookingStatus.MAINTENANCE]
+
+def to_utc_naive(value: Optional[datetime]) -> Optional[datetime]:
+    """Normalize a datetime to the naive UTC values stored in MongoDB"""
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def booking_overlap_filter(start: datetime, end: Optional[datetime] = None) -> dict:
+    """Active bookings overlapping the window [start, end); end=None means open-ended"""
+    query = {
+        "status": {"$in": ACTIVE_BOOKING_STATUSES},
+        "$or": [{"end_date": None}, {"end_date": {"$gt": start}}]
+    }
+    if end is not None:
+        query["start_date"] = {"$lt": end}
+    return query
+
+async def find_conflicting_booking(physical_unit_id: str, start: datetime, end: Optional[datetime] = None) -> Optional[dict]:
+    return await db.bookings.find_one({"physical_unit_id": physical_unit_id, **booking_overlap_filter(start, end)})
+
+async def get_busy_physical_unit_ids(start: datetime, end: Optional[datetime] = None) -> set:
+    return set(await db.bookings.distinct("physical_unit_id", booking_overlap_filter(start, end)))
+
+def availability_window(start: Optional[datetime], end: Optional[datetime]) -> tuple:
+    """Validate a requested window, defaulting its start to now"""
+    start = to_utc_naive(start) or datetime.utcnow()
+    end = to_utc_naive(end)
+    if end is not None and end <= start:
+        raise HTTPException(status_code=400, detail="End date must be after start date")
+    return start, end
+
+def virtual_unit_filter_stages(
     unit_type: Optional[UnitType] = None,
     min_price: Optional[float] = None,
     max_price: Optional[float] = None,
     pricing_period: PricingPeriod = PricingPeriod.MONTHLY,
     amenities: Optional[str] = None,
-    size_category: Optional[str] = None,
-    available_only: bool = True
-):
-    """Get virtual units with filtering options"""
-    
-    # Build filter query
+    size_category: Optional[str] = None
+) -> List[dict]:
+    """Build aggregation stages applying the storefront filters to virtual units"""
     query = {}
-    
     if unit_type:
         query["unit_type"] = unit_type
     
-    # Get all virtual units first
-    virtual_units = await db.virtual_units.find(query).to_list(1000)
-    
-    # Filter by availability if requested
-    if available_only:
-        # Get all booked physical unit IDs
-        booked_bookings = await db.bookings.find({
-            "status": {"$in": [BookingStatus.BOOKED, BookingStatus.MAINTENANCE]}
-        }).to_list(1000)
-        booked_physical_unit_ids = {booking["physical_unit_id"] for booking in booked_bookings}
-        
-        # Filter out virtual units whose physical units are booked
-        virtual_units = [unit for unit in virtual_units if unit["physical_unit_id"] not in booked_physical_unit_ids]
-    
-    # Convert to VirtualUnit objects
-    result = [VirtualUnit(**unit) for unit in virtual_units]
-    
-    # Apply additional filters
     if min_price is not None or max_price is not None:
-        filtered_result = []
-        for unit in result:
-            price = get_price_for_period(unit, pricing_period)
-            if min_price is not None and price < min_price:
-                continue
-            if max_price is not None and price > max_price:
-                continue
-            filtered_result.append(unit)
-        result = filtered_result
+        price_range = {}
+        if min_price is not None:
+            price_range["$gte"] = min_price
+        if max_price is not None:
+            price_range["$lte"] = max_price
+        query[f"{PricingPeriod(pricing_period).value}_price"] = price_range
     
     if amenities:
         amenity_list = [a.strip() for a in amenities.split(",")]
-        result = [unit for unit in result if any(amenity in unit.amenities for amenity in amenity_list)]
+        query["amenities"] = {"$in": amenity_list}
     
+    stages = [{"$match": query}] if query else []
     if size_category:
-        result = [unit for unit in result if get_size_category(unit.display_size) == size_category]
+        stages.append({"$match": {"$expr": {
+            "$eq": [size_category_expression("$display_size"), size_category]
+        }}})
+    return stages
+
+@api_router.get("/virtual-units", response_model=List[VirtualUnit])
+async def get_virtual_units(
+    response: Response,
+    unit_type: Optional[UnitType] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    pricing_period: PricingPeriod = PricingPeriod.MONTHLY,
+    amenities: Optional[str] = None,
+    size_category: Optional[str] = None,
+    available_only: bool = True,
+    availability_date: Optional[datetime] = None,
+    availability_end_date: Optional[datetime] = None,
+    limit: int = Query(1000, ge=1, le=1000),
+    cursor: Optional[str] = None
+):
+    """Get virtual units with filtering options (next page cursor in X-Next-Cursor header)"""
+    window_start, window_end = availability_window(availability_date, availability_end_date)
+    pipeline = virtual_unit_filter_stages(
+        unit_type, min_price, max_price, pricing_period, amenities, size_category
+    )
+    pipeline.append({"$sort": dict(DEFAULT_PAGE_SORT)})
+    if cursor:
+        pipeline.append({"$match": keyset_filter(cursor)})
     
-    return result
+    # Exclude virtual units whose physical unit is booked during the requested window
+    if available_only:
+        pipeline.extend([
+            {"$lookup": {
+                "from": "bookings",
+                "let": {"physical_unit_id": "$physical_unit_id"},
+                "pipeline": [
+                    {"$match": {
+                        "$expr": {"$eq": ["$physical_unit_id", "$$physical_unit_id"]},
+                        **booking_overlap_filter(window_start, window_end)
+                    }},
+                    {"$limit": 1},
+                    {"$project": {"_id": 1}}
+                ],
+                "as": "active_bookings"
+            }},
+            {"$match": {"active_bookings": {"$size": 0}}}
+        ])
+    
+    pipeline.extend([
+        {"$limit": limit + 1},
+        {"$project": {"_id": 0, "active_bookings": 0}}
+    ])
+    
+    virtual_units = await db.virtual_units.aggregate(pipeline).to_list(limit + 1)
+    if len(virtual_units) > limit:
+        virtual_units = virtual_units[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(virtual_units[-1])
+    
+    return [VirtualUnit(**unit) for unit in virtual_units]
 
 @api_router.get("/virtual-units/{unit_id}", response_model=VirtualUnit)
 async def get_virtual_unit(unit_id: str):
@@ -697,24 +1816,123 @@ async def get_virtual_unit(unit_id: str):
         raise HTTPException(status_code=404, detail="Virtual unit not found")
     return VirtualUnit(**unit)
 
+# Unit reservation holds: a checkout hold covers its own date window, and a short
+# per-unit lock serializes the check-and-write of holds and bookings
+BOOKING_HOLD_SECONDS = float(os.environ.get('BOOKING_HOLD_SECONDS', '600'))
+BOOKING_LOCK_SECONDS = float(os.environ.get('BOOKING_LOCK_SECONDS', '30'))
+BOOKING_LOCK_WAIT_SECONDS = float(os.environ.get('BOOKING_LOCK_WAIT_SECONDS', '2'))
+
+async def lock_physical_unit(physical_unit_id: str) -> Optional[str]:
+    """Take the unit's check-and-write lock, waiting briefly for another request to finish"""
+    owner = str(uuid.uuid4())
+    deadline = time.monotonic() + BOOKING_LOCK_WAIT_SECONDS
+    while not await acquire_lease(f"unit:{physical_unit_id}", owner, BOOKING_LOCK_SECONDS):
+        if time.monotonic() >= deadline:
+            return None
+        await asyncio.sleep(0.05)
+    return owner
+
+async def unlock_physical_unit(physical_unit_id: str, owner: str):
+    await release_lease(f"unit:{physical_unit_id}", owner)
+
+async def find_conflicting_hold(
+    physical_unit_id: str, start: datetime, end: Optional[datetime] = None, hold_id: Optional[str] = None
+) -> Optional[dict]:
+    """A live hold by someone else whose window overlaps [start, end)"""
+    query = {
+        "physical_unit_id": physical_unit_id,
+        "expires_at": {"$gt": datetime.utcnow()},
+        "$or": [{"end_date": None}, {"end_date": {"$gt": start}}]
+    }
+    if end is not None:
+        query["start_date"] = {"$lt": end}
+    if hold_id:
+        query["hold_id"] = {"$ne": hold_id}
+    return await db.unit_holds.find_one(query, {"_id": 0})
+
+async def migrate_unit_hold_indexes():
+    """Drop the unit-wide unique hold index so holds on separate windows can coexist"""
+    for name in ("physical_unit_id_1", "hold_id_1"):
+        try:
+            await db.unit_holds.drop_index(name)
+        except OperationFailure:
+            pass
+
+@api_router.get("/availability")
+async def get_availability(start_date: Optional[datetime] = None, end_date: Optional[datetime] = None):
+    """Get the physical units free for the whole window (start defaults to now, no end means open-ended)"""
+    window_start, window_end = availability_window(start_date, end_date)
+    busy = await get_busy_physical_unit_ids(window_start, window_end)
+    physical_units = await db.physical_units.find({}, {"_id": 0, "id": 1}).to_list(None)
+    available = [unit["id"] for unit in physical_units if unit["id"] not in busy]
+    return {
+        "start_date": window_start,
+        "end_date": window_end,
+        "available_physical_unit_ids": available,
+        "booked_physical_unit_ids": sorted(busy)
+    }
+
+@api_router.post("/bookings/holds")
+async def create_booking_hold(
+    virtual_unit_id: str,
+    hold_id: Optional[str] = None,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None
+):
+    """Hold a unit for a date window during checkout; pass hold_id again to extend or move the hold"""
+    window_start, window_end = availability_window(start_date, end_date)
+    virtual_unit = await db.virtual_units.find_one({"id": virtual_unit_id})
+    if not virtual_unit:
+        raise HTTPException(status_code=404, detail="Virtual unit not found")
+    
+    physical_unit_id = virtual_unit["physical_unit_id"]
+    lock = await lock_physical_unit(physical_unit_id)
+    if not lock:
+        raise HTTPException(status_code=409, detail="Unit is being booked, please try again")
+    try:
+        if await find_conflicting_booking(physical_unit_id, window_start, window_end):
+            raise HTTPException(status_code=409, detail="Unit is not available")
+        if await find_conflicting_hold(physical_unit_id, window_start, window_end, hold_id):
+            raise HTTPException(status_code=409, detail="Unit is held by another customer")
+        now = datetime.utcnow()
+        return await db.unit_holds.find_one_and_update(
+            {"hold_id": hold_id or str(uuid.uuid4())},
+            {
+                "$set": {
+                    "physical_unit_id": physical_unit_id,
+                    "start_date": window_start,
+                    "end_date": window_end,
+                    "expires_at": now + timedelta(seconds=BOOKING_HOLD_SECONDS)
+                },
+                "$setOnInsert": {"created_at": now}
+            },
+            upsert=True,
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+    finally:
+        await unlock_physical_unit(physical_unit_id, lock)
+
+@api_router.delete("/bookings/holds/{hold_id}")
+async def release_booking_hold(hold_id: str):
+    """Release a checkout hold"""
+    result = await db.unit_holds.delete_one({"hold_id": hold_id})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Hold not found")
+    return {"message": "Hold released successfully"}
+
 @api_router.post("/bookings", response_model=Booking)
 async def create_booking(booking_request: BookingRequest):
     """Create a new booking"""
+    start_date, end_date = to_utc_naive(booking_request.start_date), to_utc_naive(booking_request.end_date)
+    if end_date is not None and end_date <= start_date:
+        raise HTTPException(status_code=400, detail="End date must be after start date")
     
     # Verify virtual unit exists
     virtual_unit = await db.virtual_units.find_one({"id": booking_request.virtual_unit_id})
     if not virtual_unit:
         raise HTTPException(status_code=404, detail="Virtual unit not found")
     
-    # Check if physical unit is available
-    existing_booking = await db.bookings.find_one({
-        "physical_unit_id": virtual_unit["physical_unit_id"],
-        "status": {"$in": [BookingStatus.BOOKED, BookingStatus.MAINTENANCE]}
-    })
-    
-    if existing_booking:
-        raise HTTPException(status_code=409, detail="Unit is not available")
-    
     # Calculate total price
     virtual_unit_obj = VirtualUnit(**virtual_unit)
     daily_rate = get_price_for_period(virtual_unit_obj, booking_request.pricing_period)
@@ -736,24 +1954,69 @@ async def create_booking(booking_request: BookingRequest):
         customer_phone=booking_request.customer_phone,
         payment_option=booking_request.payment_option,
         pricing_period=booking_request.pricing_period,
-        start_date=booking_request.start_date,
-        end_date=booking_request.end_date,
+        start_date=start_date,
+        end_date=end_date,
         total_price=total_price,
         move_in_date=booking_request.move_in_date,
         special_requests=booking_request.special_requests
     )
     
-    booking_dict = booking.dict()
-    await db.bookings.insert_one(booking_dict)
+    # Link the booking to the CRM customer with the same email
+    customer = await db.customers.find_one({"email": booking.customer_email}, {"_id": 0, "id": 1})
+    if customer:
+        booking.customer_id = customer["id"]
+    
+    # Lock the physical unit so the availability check and insert cannot interleave with
+    # another booking or hold; the caller's own checkout hold does not count as a conflict
+    lock = await lock_physical_unit(booking.physical_unit_id)
+    if not lock:
+        raise HTTPException(status_code=409, detail="Unit is being booked, please try again")
+    try:
+        # Check the physical unit is free for the requested dates
+        if await find_conflicting_booking(booking.physical_unit_id, start_date, end_date):
+            raise HTTPException(status_code=409, detail="Unit is not available")
+        if await find_conflicting_hold(booking.physical_unit_id, start_date, end_date, booking_request.hold_id):
+            raise HTTPException(status_code=409, detail="Unit is held by another customer")
+        
+        booking_dict = booking.dict()
+        await db.bookings.insert_one(booking_dict)
+    finally:
+        await unlock_physical_unit(booking.physical_unit_id, lock)
+    # The hold has served its purpose; a failed booking above leaves it in place
+    if booking_request.hold_id:
+        await db.unit_holds.delete_one({"hold_id": booking_request.hold_id})
+    
+    if booking.customer_id:
+        await db.customers.update_one(
+            {"id": booking.customer_id},
+            {"$inc": {"total_bookings": 1}, "$set": {"last_activity": datetime.utcnow()}}
+        )
     
     return booking
 
 @api_router.get("/bookings", response_model=List[Booking])
-async def get_bookings():
-    """Get all bookings"""
-    bookings = await db.bookings.find().to_list(1000)
+async def get_bookings(response: Response, limit: int = Query(1000, ge=1, le=1000), cursor: Optional[str] = None):
+    """Get bookings (next page cursor in X-Next-Cursor header)"""
+    bookings = await paginate_find(db.bookings, {}, response, limit, cursor)
     return [Booking(**booking) for booking in bookings]
 
+@api_router.get("/bookings/export")
+async def export_bookings(
+    file_format: str = Query("ndjson", alias="format", pattern=BULK_FORMAT_PATTERN),
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    status: Optional[BookingStatus] = None,
+    fields: Optional[str] = None,
+    batch_size: int = Query(EXPORT_BATCH_SIZE, ge=100, le=10000)
+):
+    """Stream bookings created in [start_date, end_date) as NDJSON or CSV; fields is a comma-separated projection"""
+    query = date_range_filter("created_at", start_date, end_date)
+    if status:
+        query["status"] = status
+    columns = export_fields(fields, Booking)
+    cursor = export_cursor(db.bookings, query, columns, DEFAULT_PAGE_SORT, batch_size)
+    return export_response(cursor, file_format, "bookings", columns, batch_size)
+
 @api_router.get("/bookings/{booking_id}", response_model=Booking)
 async def get_booking(booking_id: str):
     """Get a specific booking"""
@@ -762,50 +2025,109 @@ async def get_booking(booking_id: str):
         raise HTTPException(status_code=404, detail="Booking not found")
     return Booking(**booking)
 
-@api_router.get("/filter-options")
-async def get_filter_options():
-    """Get available filter options"""
-    
-    # Get unique amenities
-    virtual_units = await db.virtual_units.find().to_list(1000)
-    all_amenities = set()
-    for unit in virtual_units:
-        all_amenities.update(unit.get("amenities", []))
-    
-    # Get price ranges
-    prices = []
-    for unit in virtual_units:
-        unit_obj = VirtualUnit(**unit)
-        prices.extend([unit_obj.daily_price, unit_obj.weekly_price, unit_obj.monthly_price])
-    
-    min_price = min(prices) if prices else 0
-    max_price = max(prices) if prices else 1000
-    
+# Storefront filter facets, materialized in db.filter_facets and refreshed on virtual unit writes
+def filter_facets_pipeline(filter_stages: List[dict]) -> List[dict]:
+    """Aggregation computing amenity, price, size category and unit type facets"""
+    return filter_stages + [{"$facet": {
+        "amenities": [
+            {"$unwind": "$amenities"},
+            {"$group": {"_id": "$amenities", "count": {"$sum": 1}}},
+            {"$sort": {"_id": 1}}
+        ],
+        "prices": [{"$group": {
+            "_id": None,
+            **{f"{period.value}_{bound}": {f"${bound}": f"${period.value}_price"}
+               for period in PricingPeriod for bound in ("min", "max")}
+        }}],
+        "size_categories": [{"$group": {"_id": size_category_expression("$display_size"), "count": {"$sum": 1}}}],
+        "unit_types": [{"$group": {"_id": "$unit_type", "count": {"$sum": 1}}}]
+    }}]
+
+async def compute_filter_facets(filter_stages: List[dict]) -> dict:
+    result = (await db.virtual_units.aggregate(filter_facets_pipeline(filter_stages)).to_list(1))[0]
+    prices = result["prices"][0] if result["prices"] else {}
+    return {
+        "amenities": {facet["_id"]: facet["count"] for facet in result["amenities"]},
+        "price_ranges": {
+            period.value: {"min": prices.get(f"{period.value}_min"), "max": prices.get(f"{period.value}_max")}
+            for period in PricingPeriod
+        },
+        "size_categories": {facet["_id"]: facet["count"] for facet in result["size_categories"]},
+        "unit_types": {facet["_id"]: facet["count"] for facet in result["unit_types"]}
+    }
+
+async def refresh_filter_facets() -> dict:
+    """Recompute the unfiltered facets and store them as the materialized document"""
+    facets = await compute_filter_facets([])
+    await db.filter_facets.replace_one(
+        {"id": "virtual_units"}, {"id": "virtual_units", **facets, "updated_at": datetime.utcnow()}, upsert=True
+    )
+    filter_options_cache.invalidate()
+    return facets
+
+def filter_options_response(facets: dict) -> dict:
+    """Filter options for the storefront, with facet counts alongside the original keys"""
+    prices = [
+        bound for price_range in facets["price_ranges"].values()
+        for bound in (price_range["min"], price_range["max"]) if bound is not None
+    ]
     return {
         "unit_types": [ut.value for ut in UnitType],
-        "amenities": sorted(list(all_amenities)),
+        "amenities": sorted(facets["amenities"]),
         "size_categories": ["small", "medium", "large"],
         "pricing_periods": [pp.value for pp in PricingPeriod],
         "payment_options": [po.value for po in PaymentOption],
-        "price_range": {"min": min_price, "max": max_price}
+        "price_range": {"min": min(prices) if prices else 0, "max": max(prices) if prices else 1000},
+        "facets": facets
     }
 
+filter_options_cache = ReadThroughCache(float(os.environ.get('FILTER_OPTIONS_CACHE_TTL_SECONDS', '60')))
+
+@api_router.get("/filter-options")
+async def get_filter_options(
+    request: Request,
+    unit_type: Optional[UnitType] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    pricing_period: PricingPeriod = PricingPeriod.MONTHLY,
+    amenities: Optional[str] = None,
+    size_category: Optional[str] = None
+):
+    """Get available filter options, with facet counts for the current filters"""
+    filter_stages = virtual_unit_filter_stages(unit_type, min_price, max_price, pricing_period, amenities, size_category)
+    if filter_stages:
+        return filter_options_response(await compute_filter_facets(filter_stages))
+    
+    async def load_filter_options():
+        facets = await db.filter_facets.find_one({"id": "virtual_units"}, {"_id": 0, "id": 0, "updated_at": 0})
+        if not facets:
+            facets = await compute_filter_facets([])
+        return json.dumps(filter_options_response(facets)).encode()
+    
+    body, etag, _ = await filter_options_cache.get(None, load_filter_options)
+    return cached_json_response(request, body, etag)
+
 # Image Management Routes
 
 @api_router.get("/images", response_model=List[ImageAsset])
-async def get_images(category: Optional[str] = None, tags: Optional[str] = None):
-    """Get all images, optionally filtered by category and tags"""
+async def get_images(
+    response: Response,
+    category: Optional[str] = None,
+    tags: Optional[str] = None,
+    limit: int = Query(1000, ge=1, le=1000),
+    cursor: Optional[str] = None
+):
+    """Get images, optionally filtered by category and tags (next page cursor in X-Next-Cursor header)"""
     query = {}
     if category:
         query["category"] = category
     
-    images = await db.image_assets.find(query).to_list(1000)
-    result = [ImageAsset(**img) for img in images]
-    
     # Filter by tags if provided
     if tags:
-        tag_list = [tag.strip() for tag in tags.split(",")]
-        result = [img for img in result if any(tag in img.tags for tag in tag_list)]
+        query["tags"] = {"$in": [tag.strip() for tag in tags.split(",")]}
+    
+    images = await paginate_find(db.image_assets, query, response, limit, cursor)
+    result = [ImageAsset(**img) for img in images]
     
     return result
 
@@ -845,15 +2167,35 @@ async def update_unit_image(unit_id: str, image_url: str):
 
 # Content Management Routes
 
+CONTENT_CACHE_TTL_SECONDS = float(os.environ.get('CONTENT_CACHE_TTL_SECONDS', '60'))
+content_cache = ReadThroughCache(CONTENT_CACHE_TTL_SECONDS)
+brand_settings_cache = ReadThroughCache(CONTENT_CACHE_TTL_SECONDS)
+content_block_list_adapter = TypeAdapter(List[ContentBlock])
+
 @api_router.get("/content", response_model=List[ContentBlock])
-async def get_content(section: Optional[str] = None):
-    """Get all content blocks, optionally filtered by section"""
-    query = {}
-    if section:
-        query["section"] = section
+async def get_content(
+    request: Request,
+    section: Optional[str] = None,
+    limit: int = Query(1000, ge=1, le=1000),
+    cursor: Optional[str] = None
+):
+    """Get content blocks, optionally filtered by section (next page cursor in X-Next-Cursor header)"""
+    async def load_content():
+        query = {}
+        if section:
+            query["section"] = section
+        page = Response()
+        content_blocks = await paginate_find(db.content_blocks, query, page, limit, cursor)
+        next_cursor = page.headers.get("X-Next-Cursor")
+        body = content_block_list_adapter.dump_json([ContentBlock(**block) for block in content_blocks])
+        return body, {"X-Next-Cursor": next_cursor} if next_cursor else {}
     
-    content_blocks = await db.content_blocks.find(query).to_list(1000)
-    return [ContentBlock(**block) for block in content_blocks]
+    # Only first pages are cached, so arbitrary cursors can't grow the cache
+    if cursor:
+        body, headers = await load_content()
+        return cached_json_response(request, body, make_etag(body), extra_headers=headers)
+    body, etag, headers = await content_cache.get((section, limit), load_content)
+    return cached_json_response(request, body, etag, extra_headers=headers)
 
 @api_router.get("/content/{key}", response_model=ContentBlock)
 async def get_content_by_key(key: str):
@@ -868,6 +2210,7 @@ async def create_content(content: ContentBlock):
     """Create a new content block"""
     content_dict = content.dict()
     await db.content_blocks.insert_one(content_dict)
+    content_cache.invalidate()
     return content
 
 @api_router.put("/content/{content_id}", response_model=ContentBlock)
@@ -877,6 +2220,7 @@ async def update_content(content_id: str, content: ContentBlock):
     result = await db.content_blocks.replace_one({"id": content_id}, content.dict())
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Content not found")
+    content_cache.invalidate()
     return content
 
 @api_router.put("/content/key/{key}")
@@ -892,143 +2236,757 @@ async def update_content_by_key(key: str, content_data: dict):
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Content not found")
+    content_cache.invalidate()
     return {"message": "Content updated successfully"}
 
 # Banner Management Routes
 
+class BannerIndex:
+    """Active banners grouped by funnel stage, rebuilt on writes, at the next activation boundary and after ttl"""
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._responses: Optional[Dict[Optional[str], tuple]] = None
+        self._valid_until = datetime.min
+        self._expires_at = 0.0
+        self._generation = 0
+        self._lock = asyncio.Lock()
+    
+    def invalidate(self):
+        self._generation += 1
+        self._responses = None
+    
+    def _serialize(self, banners: List[PromoBanner]) -> tuple:
+        body = promo_banner_list_adapter.dump_json(banners)
+        return body, make_etag(body)
+    
+    async def _rebuild(self, now: datetime) -> Dict[Optional[str], tuple]:
+        generation = self._generation
+        banners = [PromoBanner(**banner) for banner in await db.promo_banners.find({"is_active": True}, {"_id": 0}).to_list(None)]
+        
+        active = []
+        valid_until = now + timedelta(days=1)
+        for banner in banners:
+            start = to_utc_naive(banner.start_date)
+            # end_date is inclusive, so the banner drops out just after it
+            end = to_utc_naive(banner.end_date)
+            if start and start > now:
+                valid_until = min(valid_until, start)
+                continue
+            if end and end < now:
+                continue
+            if end:
+                valid_until = min(valid_until, end + timedelta(microseconds=1))
+            active.append(banner)
+        
+        # None holds all active banners, "" those shown at every stage
+        responses = {
+            None: self._serialize(active),
+            "": self._serialize([banner for banner in active if not banner.funnel_stages])
+        }
+        for stage in {stage for banner in active for stage in banner.funnel_stages}:
+            responses[stage] = self._serialize(
+                [banner for banner in active if stage in banner.funnel_stages or not banner.funnel_stages]
+            )
+        
+        # A write during the rebuild leaves the index stale, so only this request uses the result
+        if generation == self._generation:
+            self._responses = responses
+            self._valid_until = valid_until
+            self._expires_at = time.monotonic() + self.ttl_seconds
+        return responses
+    
+    def _is_fresh(self, now: datetime) -> bool:
+        return self._responses is not None and now < self._valid_until and time.monotonic() < self._expires_at
+    
+    async def get(self, funnel_stage: Optional[str] = None) -> tuple:
+        """Serialized active banners for a funnel stage and their ETag"""
+        now = datetime.utcnow()
+        responses = self._responses
+        if not self._is_fresh(now):
+            async with self._lock:
+                responses = self._responses if self._is_fresh(now) else await self._rebuild(now)
+        return responses.get(funnel_stage) or responses[""]
+
+promo_banner_list_adapter = TypeAdapter(List[PromoBanner])
+banner_index = BannerIndex(float(os.environ.get('BANNER_INDEX_TTL_SECONDS', '60')))
+
 @api_router.get("/banners", response_model=List[PromoBanner])
-async def get_banners(active_only: bool = False, funnel_stage: Optional[str] = None):
-    """Get banners, optionally filtered by active status and funnel stage"""
-    query = {}
+async def get_banners(
+    request: Request,
+    response: Response,
+    active_only: bool = False,
+    funnel_stage: Optional[str] = None,
+    limit: int = Query(1000, ge=1, le=1000),
+    cursor: Optional[str] = None
+):
+    """Get banners, optionally filtered by active status and funnel stage (admin listing pages via X-Next-Cursor)"""
     if active_only:
-        query["is_active"] = True
-        # Check date constraints
-        now = datetime.utcnow()
-        query["$or"] = [
-            {"start_date": None, "end_date": None},
-            {"start_date": {"$lte": now}, "end_date": None},
-            {"start_date": None, "end_date": {"$gte": now}},
-            {"start_date": {"$lte": now}, "end_date": {"$gte": now}}
-        ]
-    
-    banners = await db.promo_banners.find(query).to_list(1000)
-    result = [PromoBanner(**banner) for banner in banners]
+        body, etag = await banner_index.get(funnel_stage)
+        return cached_json_response(request, body, etag)
     
+    query = {}
     # Filter by funnel stage if provided
     if funnel_stage:
-        result = [banner for banner in result if funnel_stage in banner.funnel_stages or not banner.funnel_stages]
+        # Banners stored before funnel_stages existed have it missing or null, and show to every stage
+        query["$or"] = [{"funnel_stages": funnel_stage}, {"funnel_stages": {"$in": [None, []]}}]
+    
+    banners = await paginate_find(db.promo_banners, query, response, limit, cursor)
+    result = [PromoBanner(**banner) for banner in banners]
     
     return result
 
-@api_router.post("/banners", response_model=PromoBanner)
-async def create_banner(banner: PromoBanner):
-    """Create a new promotional banner"""
-    banner_dict = banner.dict()
-    await db.promo_banners.insert_one(banner_dict)
-    return banner
+@api_router.post("/banners", response_model=PromoBanner)
+async def create_banner(banner: PromoBanner):
+    """Create a new promotional banner"""
+    banner_dict = banner.dict()
+    await db.promo_banners.insert_one(banner_dict)
+    banner_index.invalidate()
+    return banner
+
+@api_router.put("/banners/{banner_id}", response_model=PromoBanner)
+async def update_banner(banner_id: str, banner: PromoBanner):
+    """Update existing banner"""
+    result = await db.promo_banners.replace_one({"id": banner_id}, banner.dict())
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Banner not found")
+    banner_index.invalidate()
+    return banner
+
+@api_router.delete("/banners/{banner_id}")
+async def delete_banner(banner_id: str):
+    """Delete a banner"""
+    result = await db.promo_banners.delete_one({"id": banner_id})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Banner not found")
+    banner_index.invalidate()
+    return {"message": "Banner deleted successfully"}
+
+# Funnel Tracking Routes
+
+# Funnel analytics rollups: per-hour and per-day counters keyed by location,
+# with HyperLogLog sketches of the sessions seen in each bucket
+HLL_PRECISION = 10
+HLL_REGISTERS = 1 << HLL_PRECISION
+ROLLUP_GRANULARITIES = {"hour": timedelta(hours=1), "day": timedelta(days=1)}
+
+def hll_register(value: str) -> tuple:
+    """HyperLogLog register index and rank for a value"""
+    hashed = int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+    index = hashed >> (64 - HLL_PRECISION)
+    remainder = hashed & ((1 << (64 - HLL_PRECISION)) - 1)
+    return index, (64 - HLL_PRECISION) - remainder.bit_length() + 1
+
+def hll_estimate(registers: Dict[str, int]) -> int:
+    """Estimate the number of distinct values from merged HyperLogLog registers"""
+    alpha = 0.7213 / (1 + 1.079 / HLL_REGISTERS)
+    indicator = sum(2.0 ** -rank for rank in registers.values()) + (HLL_REGISTERS - len(registers))
+    estimate = alpha * HLL_REGISTERS ** 2 / indicator
+    empty = HLL_REGISTERS - len(registers)
+    # Linear counting is more accurate for small cardinalities
+    if estimate <= 2.5 * HLL_REGISTERS and empty:
+        estimate = HLL_REGISTERS * math.log(HLL_REGISTERS / empty)
+    return round(estimate)
+
+def rollup_bucket(timestamp: datetime, granularity: str) -> datetime:
+    if granularity == "day":
+        return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+def rollup_field(event_type: str) -> str:
+    """Event type usable as a document field name"""
+    return event_type.replace(".", "_").lstrip("$") or "unknown"
+
+async def update_funnel_rollups(events: List[dict], rollups=None):
+    """Fold a batch of funnel events into the hourly and daily rollups with one bulk write"""
+    updates: Dict[tuple, dict] = {}
+    for event in events:
+        location_id = (event.get("metadata") or {}).get("location_id")
+        index, rank = hll_register(event["session_id"])
+        for granularity in ROLLUP_GRANULARITIES:
+            key = (granularity, rollup_bucket(to_utc_naive(event["timestamp"]), granularity), location_id)
+            update = updates.setdefault(key, {"$inc": {"total_events": 0}, "$max": {}})
+            update["$inc"]["total_events"] += 1
+            field = f"event_counts.{rollup_field(event['event_type'])}"
+            update["$inc"][field] = update["$inc"].get(field, 0) + 1
+            register = f"sessions_hll.{index}"
+            update["$max"][register] = max(update["$max"].get(register, 0), rank)
+
+    if updates:
+        await (rollups if rollups is not None else db.funnel_rollups).bulk_write([
+            UpdateOne({"granularity": granularity, "bucket": bucket, "location_id": location_id}, update, upsert=True)
+            for (granularity, bucket, location_id), update in updates.items()
+        ], ordered=False)
+
+def merge_funnel_rollup(summary: dict, rollup: dict):
+    """Add a rollup bucket's counters and session registers into a running summary"""
+    summary["total_events"] += rollup.get("total_events", 0)
+    for event_type, count in rollup.get("event_counts", {}).items():
+        summary["event_counts"][event_type] = summary["event_counts"].get(event_type, 0) + count
+    for index, rank in rollup.get("sessions_hll", {}).items():
+        summary["sessions_hll"][index] = max(summary["sessions_hll"].get(index, 0), rank)
+
+def empty_funnel_summary() -> dict:
+    return {"total_events": 0, "event_counts": {}, "sessions_hll": {}}
+
+async def summarize_funnel_rollups(granularity: str, since: datetime, location_id: Optional[str] = None) -> dict:
+    """Merge the rollup buckets starting at or after since"""
+    query = {"granularity": granularity, "bucket": {"$gte": rollup_bucket(since, granularity)}}
+    if location_id:
+        query["location_id"] = location_id
+    summary = empty_funnel_summary()
+    async for rollup in db.funnel_rollups.find(query, {"_id": 0, "total_events": 1, "event_counts": 1, "sessions_hll": 1}):
+        merge_funnel_rollup(summary, rollup)
+    return {
+        "unique_visitors": hll_estimate(summary["sessions_hll"]),
+        "event_counts": summary["event_counts"],
+        "total_events": summary["total_events"]
+    }
+
+FUNNEL_ROLLUPS_REBUILD_LEASE = "funnel_rollups_rebuild"
+FUNNEL_ROLLUPS_REBUILD_LEASE_SECONDS = float(os.environ.get('FUNNEL_ROLLUPS_REBUILD_LEASE_SECONDS', '300'))
+FUNNEL_ROLLUPS_STAGING_COLLECTION = "funnel_rollups_rebuild"
+
+async def funnel_rollups_deferred() -> bool:
+    """Whether a rebuild is running and live ingest should leave rollup updates to it"""
+    return await db.job_leases.find_one(
+        {"_id": FUNNEL_ROLLUPS_REBUILD_LEASE, "expires_at": {"$gt": datetime.utcnow()}, "defer_rollups": True},
+        {"_id": 1}
+    ) is not None
+
+async def set_funnel_rollups_deferred(lease_owner: str, deferred: bool):
+    await db.job_leases.update_one(
+        {"_id": FUNNEL_ROLLUPS_REBUILD_LEASE, "owner": lease_owner}, {"$set": {"defer_rollups": deferred}}
+    )
+
+async def fold_funnel_events(query: dict, rollups, lease_owner: str, mark: dict, batch_size: int) -> Optional[int]:
+    """Fold the matching raw events into a rollups collection, applying mark to each folded batch
+
+    The mark is what makes folding idempotent: it records on the events themselves that they
+    are counted, so a later pass never folds them again. The rebuild lease is renewed per batch.
+    """
+    processed = 0
+    batch = []
+    projection = {"_id": 1, "session_id": 1, "event_type": 1, "timestamp": 1, "metadata": 1}
+    
+    async def fold(batch: List[dict]) -> bool:
+        await update_funnel_rollups(batch, rollups)
+        await db.funnel_events.update_many({"_id": {"$in": [event["_id"] for event in batch]}}, mark)
+        return await renew_lease(FUNNEL_ROLLUPS_REBUILD_LEASE, lease_owner, FUNNEL_ROLLUPS_REBUILD_LEASE_SECONDS)
+    
+    async for event in db.funnel_events.find(query, projection).batch_size(batch_size):
+        batch.append(event)
+        if len(batch) >= batch_size:
+            if not await fold(batch):
+                logger.error("Lost the funnel rollups rebuild lease; abandoning the rebuild")
+                return None
+            processed += len(batch)
+            batch = []
+    if batch:
+        if not await fold(batch):
+            logger.error("Lost the funnel rollups rebuild lease; abandoning the rebuild")
+            return None
+        processed += len(batch)
+    return processed
+
+async def rebuild_funnel_rollups(batch_size: int = 5000) -> Optional[int]:
+    """Recompute all rollups from the raw funnel events; None if another rebuild holds the lease
+
+    The rollups are built in a staging collection and swapped in with one rename, so
+    readers never see a partial rebuild. While the rebuild runs, live ingest stores events
+    with rollup_pending instead of updating the rollups. Every event the rebuild counts is
+    marked with its build id, so after the swap it folds exactly the events it has not
+    counted: pending ones, and any written by a flush that started before the rebuild.
+    No wall-clock window is involved. Marking events needs update support on funnel_events,
+    which time-series collections only have from MongoDB 7.0.
+    """
+    owner = str(uuid.uuid4())
+    if not await acquire_lease(FUNNEL_ROLLUPS_REBUILD_LEASE, owner, FUNNEL_ROLLUPS_REBUILD_LEASE_SECONDS):
+        return None
+    staging = db[FUNNEL_ROLLUPS_STAGING_COLLECTION]
+    counted = {"$set": {"rollup_build": owner}, "$unset": {"rollup_pending": ""}}
+    try:
+        await set_funnel_rollups_deferred(owner, True)
+        await staging.drop()
+        await staging.create_indexes(INDEX_REGISTRY["funnel_rollups"])
+        processed = await fold_funnel_events({}, staging, owner, counted, batch_size)
+        if processed is None:
+            return None
+        await staging.rename("funnel_rollups", dropTarget=True)
+        
+        # Events the scan missed: their live updates went to the collection the swap dropped
+        while True:
+            caught_up = await fold_funnel_events(
+                {"rollup_build": {"$ne": owner}}, db.funnel_rollups, owner, counted, batch_size
+            )
+            if caught_up is None:
+                return None
+            processed += caught_up
+            if not caught_up:
+                break
+        
+        # Live ingest updates the new rollups again; anything deferred in the meantime is folded last
+        await set_funnel_rollups_deferred(owner, False)
+        pending = await fold_pending_funnel_events(owner, batch_size)
+        return processed + (pending or 0)
+    finally:
+        await release_lease(FUNNEL_ROLLUPS_REBUILD_LEASE, owner)
+
+async def fold_pending_funnel_events(lease_owner: str, batch_size: int = 5000) -> Optional[int]:
+    """Fold events stored while rollups were deferred; the caller holds the rebuild lease"""
+    return await fold_funnel_events(
+        {"rollup_pending": True}, db.funnel_rollups, lease_owner, {"$unset": {"rollup_pending": ""}}, batch_size
+    )
+
+async def sweep_pending_funnel_events() -> int:
+    """Fold events deferred by a flush that was still in flight when the last rebuild finished"""
+    owner = str(uuid.uuid4())
+    if not await acquire_lease(FUNNEL_ROLLUPS_REBUILD_LEASE, owner, FUNNEL_ROLLUPS_REBUILD_LEASE_SECONDS):
+        return 0
+    try:
+        # A lease left by a crashed rebuild may still carry its defer flag
+        await set_funnel_rollups_deferred(owner, False)
+        return await fold_pending_funnel_events(owner) or 0
+    finally:
+        await release_lease(FUNNEL_ROLLUPS_REBUILD_LEASE, owner)
+
+# Per-session funnel state, kept current on ingest so stage lookups are a single read
+FUNNEL_STAGE_WINDOW = timedelta(days=1)
+FUNNEL_STAGE_PRIORITY = [
+    ("booking_completed", "booking_completed"),
+    ("booking_abandoned", "booking_abandoned"),
+    ("booking_started", "booking_started"),
+    ("filter_used", "filtering"),
+    ("unit_viewed", "viewing_units"),
+]
+
+def epoch_hour(timestamp: datetime) -> int:
+    return int(to_utc_naive(timestamp).replace(tzinfo=timezone.utc).timestamp() // 3600)
+
+def derive_funnel_stage(last_seen: Dict[str, datetime], events_count: int, since: datetime) -> str:
+    """Funnel stage from the latest time each event type was seen within the window"""
+    for event_type, stage in FUNNEL_STAGE_PRIORITY:
+        seen = last_seen.get(event_type)
+        if seen and seen >= since:
+            return stage
+    if events_count > 5:  # Multiple page views
+        return "returning_visitor"
+    return "visitor"
+
+def funnel_session_update(events: List[dict]) -> list:
+    """Pipeline update folding one session's events into its state document"""
+    last_seen: Dict[str, datetime] = {}
+    hour_counts: Dict[int, int] = {}
+    for event in events:
+        timestamp = to_utc_naive(event["timestamp"])
+        field = rollup_field(event["event_type"])
+        last_seen[field] = max(last_seen.get(field, timestamp), timestamp)
+        hour = epoch_hour(timestamp)
+        hour_counts[hour] = hour_counts.get(hour, 0) + 1
+    
+    fields = {"last_activity": {"$max": ["$last_activity", max(last_seen.values())]}}
+    for field, timestamp in last_seen.items():
+        fields[f"last_seen.{field}"] = {"$max": [f"$last_seen.{field}", timestamp]}
+    # Event counts live in a ring of 24 hourly slots; a slot is reset when a newer hour reuses it
+    slots: Dict[int, int] = {}
+    for hour in hour_counts:
+        slots[hour % 24] = max(slots.get(hour % 24, hour), hour)
+    for slot, hour in slots.items():
+        current = f"$hour_slots.{slot}"
+        fields[f"hour_slots.{slot}"] = {"$cond": [
+            {"$eq": [f"{current}.hour", hour]},
+            {"hour": hour, "count": {"$add": [f"{current}.count", hour_counts[hour]]}},
+            {"$cond": [{"$gt": [f"{current}.hour", hour]}, current, {"hour": hour, "count": hour_counts[hour]}]}
+        ]}
+    return [{"$set": fields}]
+
+async def update_funnel_sessions(events: List[dict]):
+    """Update the state documents of every session in a batch of events with one bulk write"""
+    sessions: Dict[str, List[dict]] = {}
+    for event in events:
+        sessions.setdefault(event["session_id"], []).append(event)
+    if sessions:
+        await db.funnel_sessions.bulk_write([
+            UpdateOne({"session_id": session_id}, funnel_session_update(session_events), upsert=True)
+            for session_id, session_events in sessions.items()
+        ], ordered=False)
+
+async def rebuild_funnel_sessions(batch_size: int = 5000) -> int:
+    """Recompute session state from the events inside the stage window"""
+    await db.funnel_sessions.delete_many({})
+    processed = 0
+    batch = []
+    since = datetime.utcnow() - FUNNEL_STAGE_WINDOW
+    async for event in db.funnel_events.find(
+        {"timestamp": {"$gte": since}}, {"_id": 0, "session_id": 1, "event_type": 1, "timestamp": 1}
+    ).batch_size(batch_size):
+        batch.append(event)
+        if len(batch) >= batch_size:
+            await update_funnel_sessions(batch)
+            processed += len(batch)
+            batch = []
+    if batch:
+        await update_funnel_sessions(batch)
+        processed += len(batch)
+    return processed
+
+FUNNEL_BUFFER_MAX_EVENTS = int(os.environ.get('FUNNEL_BUFFER_MAX_EVENTS', '1000'))
+FUNNEL_BUFFER_FLUSH_SECONDS = float(os.environ.get('FUNNEL_BUFFER_FLUSH_SECONDS', '1'))
+FUNNEL_BATCH_MAX_EVENTS = 500
+
+def funnel_event_document(event: dict, rollup_pending: bool = False) -> dict:
+    """Store funnel events under their own id so a retried insert is rejected as a duplicate"""
+    document = {"_id": event["id"], **event, "ingested_at": datetime.utcnow()}
+    if rollup_pending:
+        # Left for the running rollup rebuild to count
+        document["rollup_pending"] = True
+    return document
+
+def is_storable_funnel_event(event: dict) -> bool:
+    """Whether an event encodes as BSON (no NUL in keys, integers within 8 bytes)"""
+    try:
+        bson.encode(funnel_event_document(event))
+    except (InvalidDocument, OverflowError):
+        return False
+    return True
+
+async def insert_funnel_events(events: List[dict], rollup_pending: bool = False) -> List[dict]:
+    """Insert funnel events in one unordered write, returning the ones newly stored"""
+    if not events:
+        return []
+    try:
+        await db.funnel_events.insert_many(
+            [funnel_event_document(event, rollup_pending) for event in events], ordered=False
+        )
+        return events
+    except BulkWriteError as e:
+        # Unordered inserts keep going past individual failures; duplicates are events a
+        # previous attempt already stored, so only the rows that newly landed are counted
+        errors = e.details.get("writeErrors", [])
+        failed = {error["index"] for error in errors}
+        dropped = [error for error in errors if error.get("code") != 11000]
+        if dropped:
+            logger.warning(f"Dropped {len(dropped)} of {len(events)} funnel events: {dropped[:1]}")
+        return [event for index, event in enumerate(events) if index not in failed]
 
-@api_router.put("/banners/{banner_id}", response_model=PromoBanner)
-async def update_banner(banner_id: str, banner: PromoBanner):
-    """Update existing banner"""
-    result = await db.promo_banners.replace_one({"id": banner_id}, banner.dict())
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Banner not found")
-    return banner
+async def apply_funnel_events(events: List[dict], update_rollups: bool = True):
+    """Fold stored funnel events into the rollups and session stages"""
+    try:
+        if update_rollups:
+            await asyncio.gather(update_funnel_rollups(events), update_funnel_sessions(events))
+        else:
+            await update_funnel_sessions(events)
+    except Exception as e:
+        # The events are stored, so retrying would count them twice; a rollup rebuild recovers
+        logger.error(f"Failed to update funnel rollups for {len(events)} events: {e}")
 
-@api_router.delete("/banners/{banner_id}")
-async def delete_banner(banner_id: str):
-    """Delete a banner"""
-    result = await db.promo_banners.delete_one({"id": banner_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Banner not found")
-    return {"message": "Banner deleted successfully"}
+class FunnelEventBuffer:
+    """Collects tracked events in memory and writes them in batches on size or time thresholds"""
+    def __init__(self, max_events: int, flush_seconds: float):
+        self.max_events = max_events
+        self.flush_seconds = flush_seconds
+        self._events: List[dict] = []
+        self._retried: set = set()
+        self._lock = asyncio.Lock()
+    
+    def __len__(self):
+        return len(self._events)
+    
+    async def add(self, events: List[dict]):
+        self._events.extend(events)
+        if len(self._events) >= self.max_events:
+            await self.flush()
+    
+    async def _drop_stored(self, batch: List[dict]) -> List[dict]:
+        """Skip retried events a failed insert already stored (time-series _id is not unique)"""
+        retried = [event["id"] for event in batch if event["id"] in self._retried]
+        if not retried:
+            return batch
+        stored = set(await db.funnel_events.distinct("_id", {"_id": {"$in": retried}}))
+        self._retried.difference_update(retried)
+        return [event for event in batch if event["id"] not in stored]
+    
+    async def flush(self) -> int:
+        async with self._lock:
+            written = 0
+            while self._events:
+                batch, self._events = self._events[:self.max_events], self._events[self.max_events:]
+                try:
+                    deferred = await funnel_rollups_deferred()
+                    stored = await insert_funnel_events(await self._drop_stored(batch), deferred)
+                except Exception as e:
+                    # Rows that cannot be encoded are dropped; the rest of the batch is retried,
+                    # up to a bounded backlog
+                    logger.error(f"Failed to flush {len(batch)} funnel events: {e}")
+                    storable = [event for event in batch if is_storable_funnel_event(event)]
+                    if len(storable) < len(batch):
+                        logger.warning(f"Dropped {len(batch) - len(storable)} unencodable funnel events")
+                        self._events = storable + self._events
+                        continue
+                    self._events = (batch + self._events)[-self.max_events * 10:]
+                    self._retried.update(event["id"] for event in batch)
+                    self._retried &= {event["id"] for event in self._events}
+                    break
+                await apply_funnel_events(stored, update_rollups=not deferred)
+                written += len(stored)
+            return written
+    
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Funnel event flush failed: {e}")
 
-# Funnel Tracking Routes
+funnel_event_buffer = FunnelEventBuffer(FUNNEL_BUFFER_MAX_EVENTS, FUNNEL_BUFFER_FLUSH_SECONDS)
 
 @api_router.post("/funnel/track")
 async def track_funnel_event(event: FunnelEvent):
     """Track a funnel event"""
-    event_dict = event.dict()
-    await db.funnel_events.insert_one(event_dict)
+    if not is_storable_funnel_event(event.dict()):
+        raise HTTPException(status_code=422, detail="Event cannot be stored (NUL in a key or an integer over 8 bytes)")
+    await funnel_event_buffer.add([event.dict()])
     return {"message": "Event tracked successfully"}
 
+@api_router.post("/funnel/track/batch")
+async def track_funnel_events(events: List[FunnelEvent]):
+    """Track a batch of funnel events"""
+    if len(events) > FUNNEL_BATCH_MAX_EVENTS:
+        raise HTTPException(status_code=413, detail=f"At most {FUNNEL_BATCH_MAX_EVENTS} events per batch")
+    documents = [event.dict() for event in events]
+    rejected = [index for index, document in enumerate(documents) if not is_storable_funnel_event(document)]
+    if rejected:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Events at positions {rejected[:10]} cannot be stored (NUL in a key or an integer over 8 bytes)"
+        )
+    await funnel_event_buffer.add(documents)
+    return {"message": "Events tracked successfully", "count": len(events)}
+
+def write_archive_lines(path: Path, lines: List[str]):
+    with gzip.open(path, "at", encoding="utf-8") as archive:
+        archive.writelines(lines)
+
+FUNNEL_ARCHIVE_CLAIM_SECONDS = float(os.environ.get('FUNNEL_ARCHIVE_CLAIM_SECONDS', '3600'))
+
+def archive_day_filter(time_field: str, day: datetime, end: datetime) -> dict:
+    """Events in a day by the field retention expires them by"""
+    query = {time_field: {"$gte": day, "$lt": end}}
+    if time_field == "ingested_at":
+        # Events stored before ingested_at existed go by their timestamp until backfilled
+        query = {"$or": [query, {"ingested_at": {"$exists": False}, "timestamp": {"$gte": day, "$lt": end}}]}
+    return query
+
+async def claim_funnel_archive_day(day: datetime, owner: str) -> bool:
+    """Claim a day for export, unless it is archived or another worker's claim is still fresh"""
+    now = datetime.utcnow()
+    try:
+        await db.funnel_archives.update_one(
+            {"id": f"{day:%Y-%m-%d}", "status": "pending",
+             "claimed_at": {"$lte": now - timedelta(seconds=FUNNEL_ARCHIVE_CLAIM_SECONDS)}},
+            {"$set": {"start": day, "end": day + timedelta(days=1), "claim_owner": owner, "claimed_at": now}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+def finish_archive_file(partial: Path, path: Optional[Path]):
+    if path:
+        os.replace(partial, path)
+    else:
+        partial.unlink(missing_ok=True)
+
+async def archive_funnel_events(batch_size: int = 5000) -> int:
+    """Export whole days of funnel events, by ingest time, to NDJSON files before retention expires them
+
+    Days are claimed in db.funnel_archives before export, so the worker loop and the admin
+    endpoint never write the same file. Days are keyed on the field retention expires by
+    (ingested_at, or the timeField of a time-series collection created on timestamp), so a
+    late event with an old client timestamp neither lands in an archived day nor expires early.
+    """
+    if not FUNNEL_EVENTS_ARCHIVE_DIR:
+        return 0
+    archive_dir = Path(FUNNEL_EVENTS_ARCHIVE_DIR)
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    
+    # Archive each day once it is complete. With retention, day D starts expiring at D + retention,
+    # so it is archived from D + retention - 1 day, a full day before its first events expire
+    cutoff = rollup_bucket(datetime.utcnow(), "day")
+    if FUNNEL_EVENTS_RETENTION_SECONDS:
+        cutoff = min(cutoff, rollup_bucket(
+            datetime.utcnow() - timedelta(seconds=FUNNEL_EVENTS_RETENTION_SECONDS) + timedelta(days=2), "day"
+        ))
+    time_field = await funnel_events_time_field()
+    
+    last_archive = await db.funnel_archives.find_one({"status": {"$ne": "pending"}}, sort=[("end", -1)])
+    if last_archive:
+        day = last_archive["end"]
+    else:
+        # Legacy events may lack ingested_at, so start from the earlier of both fields
+        first_times = []
+        for field in {"timestamp", time_field}:
+            first_event = await db.funnel_events.find_one({field: {"$ne": None}}, {field: 1}, sort=[(field, 1)])
+            if first_event:
+                first_times.append(first_event[field])
+        if not first_times:
+            return 0
+        day = rollup_bucket(min(first_times), "day")
+    
+    owner = str(uuid.uuid4())
+    archived = 0
+    loop = asyncio.get_running_loop()
+    while day + timedelta(days=1) <= cutoff:
+        end = day + timedelta(days=1)
+        if not await claim_funnel_archive_day(day, owner):
+            # Another run is exporting this day and will carry on from it
+            break
+        path = archive_dir / f"funnel_events-{day:%Y-%m-%d}.ndjson.gz"
+        partial = path.with_name(f"{path.name}.{owner}.partial")
+        count = 0
+        lines = []
+        async for event in db.funnel_events.find(
+            archive_day_filter(time_field, day, end), {"_id": 0}
+        ).batch_size(batch_size):
+            lines.append(json_util.dumps(event) + "\n")
+            if len(lines) >= batch_size:
+                await loop.run_in_executor(None, write_archive_lines, partial, lines)
+                count += len(lines)
+                lines = []
+        if lines:
+            await loop.run_in_executor(None, write_archive_lines, partial, lines)
+            count += len(lines)
+        
+        await loop.run_in_executor(None, finish_archive_file, partial, path if count else None)
+        result = await db.funnel_archives.update_one(
+            {"id": f"{day:%Y-%m-%d}", "status": "pending", "claim_owner": owner},
+            {
+                "$set": {"status": "archived", "path": str(path) if count else None, "events": count,
+                         "created_at": datetime.utcnow()},
+                "$unset": {"claim_owner": "", "claimed_at": ""}
+            }
+        )
+        if result.matched_count == 0:
+            logger.warning(f"Funnel archive claim for {day:%Y-%m-%d} expired before the export finished")
+            break
+        archived += count
+        day = end
+    return archived
+
+@api_router.post("/admin/funnel-events/archive")
+async def run_funnel_events_archive():
+    """Archive complete days of funnel events that have not been exported yet"""
+    if not FUNNEL_EVENTS_ARCHIVE_DIR:
+        raise HTTPException(status_code=400, detail="FUNNEL_EVENTS_ARCHIVE_DIR is not configured")
+    archived = await archive_funnel_events()
+    return {"message": "Funnel events archived", "events_archived": archived}
+
+@api_router.get("/admin/funnel-events/archives")
+async def get_funnel_events_archives(limit: int = Query(100, ge=1, le=1000)):
+    """List exported funnel event archives, newest first"""
+    return await db.funnel_archives.find({}, {"_id": 0}).sort("end", -1).to_list(limit)
+
+@api_router.get("/funnel/events/export")
+async def export_funnel_events(
+    file_format: str = Query("ndjson", alias="format", pattern=BULK_FORMAT_PATTERN),
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    event_type: Optional[str] = None,
+    fields: Optional[str] = None,
+    batch_size: int = Query(EXPORT_BATCH_SIZE, ge=100, le=10000)
+):
+    """Stream funnel events in [start_date, end_date) as NDJSON or CSV; fields is a comma-separated projection"""
+    query = date_range_filter("timestamp", start_date, end_date)
+    if event_type:
+        query["event_type"] = event_type
+    columns = export_fields(fields, FunnelEvent)
+    cursor = export_cursor(db.funnel_events, query, columns, [("timestamp", ASCENDING)], batch_size)
+    return export_response(cursor, file_format, "funnel_events", columns, batch_size)
+
 @api_router.get("/funnel/user/{session_id}")
 async def get_user_funnel_stage(session_id: str):
     """Get current funnel stage for a user session"""
-    # Get recent events for this session (last 24 hours)
-    since = datetime.utcnow() - timedelta(days=1)
-    events = await db.funnel_events.find({
-        "session_id": session_id,
-        "timestamp": {"$gte": since}
-    }).sort("timestamp", -1).to_list(100)
-    
-    if not events:
+    session = await db.funnel_sessions.find_one({"session_id": session_id}, {"_id": 0})
+    since = datetime.utcnow() - FUNNEL_STAGE_WINDOW
+    if not session or session["last_activity"] < since:
         return {"funnel_stage": "visitor", "events_count": 0}
     
-    # Determine funnel stage based on events
-    event_types = [event["event_type"] for event in events]
-    
-    if "booking_completed" in event_types:
-        stage = "booking_completed"
-    elif "booking_abandoned" in event_types:
-        stage = "booking_abandoned"
-    elif "booking_started" in event_types:
-        stage = "booking_started"
-    elif "filter_used" in event_types:
-        stage = "filtering"
-    elif "unit_viewed" in event_types:
-        stage = "viewing_units"
-    elif len(events) > 5:  # Multiple page views
-        stage = "returning_visitor"
-    else:
-        stage = "visitor"
+    first_hour = epoch_hour(since)
+    events_count = sum(
+        slot["count"] for slot in session.get("hour_slots", {}).values() if slot["hour"] >= first_hour
+    )
     
     return {
-        "funnel_stage": stage,
-        "events_count": len(events),
-        "last_activity": events[0]["timestamp"] if events else None
+        "funnel_stage": derive_funnel_stage(session.get("last_seen", {}), events_count, since),
+        "events_count": events_count,
+        "last_activity": session["last_activity"]
     }
 
 @api_router.get("/admin/analytics")
 async def get_admin_analytics():
     """Get analytics data for admin dashboard"""
     # Get total counts
-    total_units = await db.virtual_units.count_documents({})
-    total_bookings = await db.bookings.count_documents({})
-    total_images = await db.image_assets.count_documents({})
+    total_units, total_bookings, total_images = await asyncio.gather(
+        db.virtual_units.estimated_document_count(),
+        db.bookings.estimated_document_count(),
+        db.image_assets.estimated_document_count()
+    )
     
-    # Get recent funnel events (last 7 days)
+    # Funnel activity for the last 7 days, from hourly rollups
     since = datetime.utcnow() - timedelta(days=7)
-    recent_events = await db.funnel_events.find({
-        "timestamp": {"$gte": since}
-    }).to_list(1000)
-    
-    # Count events by type
-    event_counts = {}
-    for event in recent_events:
-        event_type = event["event_type"]
-        event_counts[event_type] = event_counts.get(event_type, 0) + 1
-    
-    # Get unique sessions
-    unique_sessions = len(set(event["session_id"] for event in recent_events))
     
     return {
         "total_units": total_units,
         "total_bookings": total_bookings,
         "total_images": total_images,
-        "last_7_days": {
-            "unique_visitors": unique_sessions,
-            "event_counts": event_counts,
-            "total_events": len(recent_events)
-        }
+        "last_7_days": await summarize_funnel_rollups("hour", since)
     }
 
+@api_router.get("/admin/analytics/timeseries")
+async def get_analytics_timeseries(
+    granularity: str = Query("day", pattern="^(hour|day)$"),
+    days: int = Query(30, ge=1, le=366),
+    location_id: Optional[str] = None
+):
+    """Get funnel event counts and unique visitors per hour or day bucket"""
+    since = rollup_bucket(datetime.utcnow() - timedelta(days=days), granularity)
+    query = {"granularity": granularity, "bucket": {"$gte": since}}
+    if location_id:
+        query["location_id"] = location_id
+    
+    buckets: Dict[datetime, dict] = {}
+    async for rollup in db.funnel_rollups.find(query, {"_id": 0}).sort("bucket", 1):
+        merge_funnel_rollup(buckets.setdefault(rollup["bucket"], empty_funnel_summary()), rollup)
+    
+    return [
+        {
+            "bucket": bucket_start,
+            "total_events": bucket["total_events"],
+            "event_counts": bucket["event_counts"],
+            "unique_visitors": hll_estimate(bucket["sessions_hll"])
+        }
+        for bucket_start, bucket in buckets.items()
+    ]
+
+@api_router.post("/admin/analytics/rebuild-rollups")
+async def rebuild_analytics_rollups():
+    """Recompute funnel rollups from raw events"""
+    processed = await rebuild_funnel_rollups()
+    if processed is None:
+        raise HTTPException(status_code=409, detail="A rollup rebuild is already running")
+    return {"message": "Rollups rebuilt successfully", "events_processed": processed}
+
+@api_router.get("/admin/indexes")
+async def get_index_report():
+    """Get index usage report for all registered collections"""
+    return await get_index_usage_report()
+
 # API Key Management Routes
 
 @api_router.get("/api-keys", response_model=List[Dict[str, Any]])
-async def get_api_keys():
-    """Get all API keys (values masked for security)"""
-    api_keys = await db.api_keys.find().to_list(1000)
+async def get_api_keys(response: Response, limit: int = Query(1000, ge=1, le=1000), cursor: Optional[str] = None):
+    """Get API keys, values masked for security (next page cursor in X-Next-Cursor header)"""
+    api_keys = await paginate_find(db.api_keys, {}, response, limit, cursor)
     # Mask sensitive values
     for key in api_keys:
         if len(key["key_value"]) > 8:
@@ -1056,6 +3014,7 @@ async def create_api_key(api_key: APIKey):
         await db.api_keys.insert_one(api_key.dict())
     
     # Reconfigure services
+    credentials_cache.invalidate()
     await configure_services()
     
     return api_key
@@ -1068,6 +3027,7 @@ async def delete_api_key(key_id: str):
         raise HTTPException(status_code=404, detail="API key not found")
     
     # Reconfigure services
+    credentials_cache.invalidate()
     await configure_services()
     
     return {"message": "API key deleted successfully"}
@@ -1120,7 +3080,7 @@ async def create_payment_checkout(
     success_url = f"{origin_url}/payment/success"
     cancel_url = f"{origin_url}/payment/cancel"
     
-    result = stripe_service.create_checkout_session(
+    result = await stripe_service.create_checkout_session_async(
         amount=amount,
         success_url=success_url,
         cancel_url=cancel_url,
@@ -1149,7 +3109,7 @@ async def get_payment_status(session_id: str):
     if not stripe_service:
         raise HTTPException(status_code=503, detail="Payment processing not configured")
     
-    result = stripe_service.get_payment_status(session_id)
+    result = await stripe_service.get_payment_status_async(session_id)
     
     if result["success"]:
         # Update transaction status if paid
@@ -1163,13 +3123,81 @@ async def get_payment_status(session_id: str):
     else:
         raise HTTPException(status_code=500, detail=result["error"])
 
+# Notification Template Routes
+
+async def render_email_template(trigger: str, default_template: str, default_subject: str, data: dict) -> tuple:
+    """Render the active DB email template for a trigger, falling back to the built-in template"""
+    template = await db.notification_templates.find_one(
+        {"trigger": trigger, "template_type": "email", "is_active": True}, {"_id": 0}
+    )
+    if template:
+        return template.get("subject") or default_subject, template_registry.render_db_template(template, **data)
+    return default_subject, template_registry.render(default_template, **data)
+
+@api_router.get("/notification-templates", response_model=List[NotificationTemplate])
+async def get_notification_templates(
+    response: Response,
+    trigger: Optional[str] = None,
+    limit: int = Query(1000, ge=1, le=1000),
+    cursor: Optional[str] = None
+):
+    """Get notification templates, optionally filtered by trigger (next page cursor in X-Next-Cursor header)"""
+    query = {"trigger": trigger} if trigger else {}
+    templates = await paginate_find(db.notification_templates, query, response, limit, cursor)
+    return [NotificationTemplate(**template) for template in templates]
+
+@api_router.post("/notification-templates", response_model=NotificationTemplate)
+async def create_notification_template(template: NotificationTemplate):
+    """Create a notification template"""
+    template.version = 1
+    await db.notification_templates.insert_one(template.dict())
+    return template
+
+@api_router.put("/notification-templates/{template_id}", response_model=NotificationTemplate)
+async def update_notification_template(template_id: str, template: NotificationTemplate):
+    """Update a notification template, bumping its version"""
+    existing = await db.notification_templates.find_one({"id": template_id})
+    if not existing:
+        raise HTTPException(status_code=404, detail="Template not found")
+    
+    template.id = template_id
+    template.created_at = existing["created_at"]
+    template.version = existing.get("version", 1) + 1
+    template.updated_at = datetime.utcnow()
+    # Only replace the version we read so concurrent edits cannot both win
+    result = await db.notification_templates.replace_one(
+        {"id": template_id, "version": existing.get("version", 1)}, template.dict()
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=409, detail="Template was modified concurrently")
+    template_registry.invalidate(template_id)
+    return template
+
+@api_router.delete("/notification-templates/{template_id}")
+async def delete_notification_template(template_id: str):
+    """Delete a notification template"""
+    result = await db.notification_templates.delete_one({"id": template_id})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Template not found")
+    template_registry.invalidate(template_id)
+    return {"message": "Template deleted successfully"}
+
+@api_router.post("/notification-templates/{template_id}/preview")
+async def preview_notification_template(template_id: str, data: Dict[str, Any]):
+    """Render a notification template with sample data"""
+    template = await db.notification_templates.find_one({"id": template_id}, {"_id": 0})
+    if not template:
+        raise HTTPException(status_code=404, detail="Template not found")
+    try:
+        content = template_registry.render_db_template(template, **data)
+    except SecurityError as e:
+        raise HTTPException(status_code=400, detail=f"Template uses a disallowed operation: {e}")
+    return {"subject": template.get("subject"), "content": content}
+
 # Notification Routes
 
 @api_router.post("/notifications/send-booking-confirmation")
-async def send_booking_confirmation(
-    booking_id: str,
-    background_tasks: BackgroundTasks
-):
+async def send_booking_confirmation(booking_id: str):
     """Send booking confirmation via SMS and Email"""
     await configure_services()
     
@@ -1197,36 +3225,42 @@ async def send_booking_confirmation(
         "booking_id": booking["id"]
     }
     
+    notifications = []
+    
     # Send SMS if configured and phone provided
     if twilio_service and twilio_service.client and customer_data["phone"]:
-        background_tasks.add_task(
-            send_sms_notification,
-            customer_data["phone"],
-            SMSTemplates.booking_confirmation(
+        notifications.append(NotificationOutboxItem(
+            channel="sms",
+            recipient=customer_data["phone"],
+            content=SMSTemplates.booking_confirmation(
                 customer_data["name"],
                 booking_data["unit_name"],
                 booking_data["move_in_date"],
                 booking_data["amount"]
             )
-        )
+        ))
     
     # Send Email if configured and email provided
     if email_service and email_service.sg and customer_data["email"]:
-        background_tasks.add_task(
-            send_email_notification,
-            customer_data["email"],
+        subject, html_content = await render_email_template(
+            "booking_confirmed",
+            "booking_confirmation",
             "🎉 Booking Confirmed - RV & Boat Storage",
-            EmailTemplates.BOOKING_CONFIRMATION,
-            {**customer_data, **booking_data, "manage_booking_url": "#"}
+            {**customer_data, **booking_data, "customer_name": customer_data["name"], "manage_booking_url": "#"}
         )
+        notifications.append(NotificationOutboxItem(
+            channel="email",
+            recipient=customer_data["email"],
+            subject=subject,
+            content=html_content
+        ))
+    
+    await enqueue_notifications(notifications)
     
     return {"message": "Notifications queued for sending"}
 
 @api_router.post("/notifications/send-payment-confirmation")
-async def send_payment_confirmation(
-    transaction_id: str,
-    background_tasks: BackgroundTasks
-):
+async def send_payment_confirmation(transaction_id: str):
     """Send payment confirmation via SMS and Email"""
     await configure_services()
     
@@ -1252,72 +3286,525 @@ async def send_payment_confirmation(
         "next_due_date": "1st of next month"
     }
     
+    notifications = []
+    
     # Send SMS
     if twilio_service and twilio_service.client and customer_data["phone"]:
-        background_tasks.add_task(
-            send_sms_notification,
-            customer_data["phone"],
-            SMSTemplates.payment_confirmation(
+        notifications.append(NotificationOutboxItem(
+            channel="sms",
+            recipient=customer_data["phone"],
+            content=SMSTemplates.payment_confirmation(
                 customer_data["name"],
                 payment_data["amount"],
                 payment_data["unit_name"]
             )
-        )
+        ))
     
     # Send Email
     if email_service and email_service.sg and customer_data["email"]:
-        background_tasks.add_task(
-            send_email_notification,
-            customer_data["email"],
+        subject, html_content = await render_email_template(
+            "payment_received",
+            "payment_confirmation",
             "✅ Payment Received - Thank You!",
-            EmailTemplates.PAYMENT_CONFIRMATION,
-            {**customer_data, **payment_data}
+            {**customer_data, **payment_data, "customer_name": customer_data["name"]}
         )
+        notifications.append(NotificationOutboxItem(
+            channel="email",
+            recipient=customer_data["email"],
+            subject=subject,
+            content=html_content
+        ))
+    
+    await enqueue_notifications(notifications)
     
     return {"message": "Payment confirmation notifications sent"}
 
-# Helper functions for background tasks
-async def send_sms_notification(phone: str, message: str):
-    """Background task to send SMS"""
-    if twilio_service and twilio_service.client:
-        result = twilio_service.send_sms(phone, message)
-        if not result["success"]:
-            logger.error(f"SMS sending failed: {result['error']}")
-
-async def send_email_notification(email: str, subject: str, template: str, data: dict):
-    """Background task to send email"""
-    if email_service and email_service.sg:
-        html_content = Template(template).render(**data)
-        result = email_service.send_email(email, subject, html_content)
-        if not result["success"]:
-            logger.error(f"Email sending failed: {result['error']}")
+@api_router.get("/notifications/outbox/stats")
+async def get_outbox_stats():
+    """Get outbox item counts by channel and status"""
+    counts = await db.notification_outbox.aggregate([
+        {"$group": {"_id": {"channel": "$channel", "status": "$status"}, "count": {"$sum": 1}}}
+    ]).to_list(None)
+    stats = {}
+    for entry in counts:
+        stats.setdefault(entry["_id"]["channel"], {})[entry["_id"]["status"]] = entry["count"]
+    return stats
+
+@api_router.post("/notifications/outbox/{item_id}/retry")
+async def retry_outbox_item(item_id: str):
+    """Move a dead-lettered notification back to the pending queue"""
+    result = await db.notification_outbox.update_one(
+        {"id": item_id, "status": "dead"},
+        {"$set": {
+            "status": "pending",
+            "attempts": 0,
+            "next_attempt_at": datetime.utcnow(),
+            "updated_at": datetime.utcnow()
+        }}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Dead-lettered notification not found")
+    return {"message": "Notification requeued"}
+
+@api_router.post("/notifications/campaigns", response_model=NotificationCampaign)
+async def create_campaign(campaign: NotificationCampaign):
+    """Queue a bulk email or SMS campaign for the notification worker"""
+    if campaign.channel not in ("email", "sms"):
+        raise HTTPException(status_code=400, detail="Channel must be email or sms")
+    if campaign.template_id:
+        if not await db.notification_templates.find_one({"id": campaign.template_id}):
+            raise HTTPException(status_code=404, detail="Template not found")
+    elif not campaign.content or (campaign.channel == "email" and not campaign.subject):
+        raise HTTPException(status_code=400, detail="Campaign needs a template_id or subject and content")
+    
+    campaign.status = "queued"
+    campaign.total_recipients = await db.customers.count_documents(
+        campaign_audience_query(campaign.channel, campaign.audience)
+    )
+    await db.notification_campaigns.insert_one(campaign.dict())
+    return campaign
+
+@api_router.get("/notifications/campaigns", response_model=List[NotificationCampaign])
+async def get_campaigns(
+    response: Response,
+    status: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None
+):
+    """Get campaigns, most recent first (next page cursor in X-Next-Cursor header)"""
+    query = {"status": status} if status else {}
+    campaigns = await paginate_find(db.notification_campaigns, query, response, limit, cursor, NEWEST_FIRST_SORT)
+    return [NotificationCampaign(**campaign) for campaign in campaigns]
+
+@api_router.get("/notifications/campaigns/{campaign_id}")
+async def get_campaign_progress(campaign_id: str):
+    """Get campaign progress and throughput"""
+    campaign = await db.notification_campaigns.find_one({"id": campaign_id}, {"_id": 0, "cursor": 0})
+    if not campaign:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    processed = campaign["sent"] + campaign["failed"]
+    total = campaign["total_recipients"]
+    campaign["progress"] = round(100 * processed / total, 1) if total else 100.0
+    return campaign
+
+# Notification outbox (drained by notification_worker.py)
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '50'))
+OUTBOX_LEASE_SECONDS = float(os.environ.get('OUTBOX_LEASE_SECONDS', '120'))
+OUTBOX_RETRY_BASE_SECONDS = float(os.environ.get('OUTBOX_RETRY_BASE_SECONDS', '30'))
+OUTBOX_RETRY_MAX_SECONDS = float(os.environ.get('OUTBOX_RETRY_MAX_SECONDS', '3600'))
+
+class RateLimiter:
+    """Token bucket allowing rate_per_second acquisitions with bursts up to burst"""
+    def __init__(self, rate_per_second: float, burst: Optional[int] = None):
+        self.rate_per_second = rate_per_second
+        self.burst = burst or max(1, int(rate_per_second))
+        self._tokens = float(self.burst)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate_per_second)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate_per_second)
+
+outbox_rate_limiters = {
+    "sms": RateLimiter(float(os.environ.get('OUTBOX_SMS_RATE_PER_SECOND', '1'))),
+    "email": RateLimiter(float(os.environ.get('OUTBOX_EMAIL_RATE_PER_SECOND', '10')))
+}
+# Campaigns draw from their own buckets so a large send never queues ahead of confirmations;
+# keep outbox plus campaign rates within the provider account's limits
+campaign_rate_limiters = {
+    "sms": RateLimiter(float(os.environ.get('CAMPAIGN_SMS_RATE_PER_SECOND', '1'))),
+    "email": RateLimiter(float(os.environ.get('CAMPAIGN_EMAIL_RATE_PER_SECOND', '1')))
+}
+
+async def enqueue_notifications(notifications: List[NotificationOutboxItem]):
+    """Persist notifications to the outbox for the worker to deliver"""
+    if notifications:
+        await db.notification_outbox.insert_many([item.dict() for item in notifications])
+
+async def claim_outbox_batch(channel: str, batch_size: int = OUTBOX_BATCH_SIZE) -> List[dict]:
+    """Lease a batch of due notifications so no other worker sends them concurrently"""
+    now = datetime.utcnow()
+    claimable = {
+        "channel": channel,
+        "$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            # Leases left behind by a crashed worker
+            {"status": "processing", "locked_until": {"$lte": now}}
+        ]
+    }
+    candidates = await db.notification_outbox.find(claimable, {"_id": 0, "id": 1}) \
+        .sort("next_attempt_at", 1).limit(batch_size).to_list(batch_size)
+    if not candidates:
+        return []
+    
+    claim_id = str(uuid.uuid4())
+    await db.notification_outbox.update_many(
+        {**claimable, "id": {"$in": [item["id"] for item in candidates]}},
+        {
+            "$set": {
+                "status": "processing",
+                "claim_id": claim_id,
+                "locked_until": now + timedelta(seconds=OUTBOX_LEASE_SECONDS),
+                "updated_at": now
+            },
+            "$inc": {"attempts": 1}
+        }
+    )
+    return await db.notification_outbox.find({"claim_id": claim_id}, {"_id": 0}).to_list(batch_size)
+
+async def deliver_notification(item: dict) -> dict:
+    """Send one outbox item through its channel's provider"""
+    await outbox_rate_limiters[item["channel"]].acquire()
+    if item["channel"] == "sms":
+        if not (twilio_service and twilio_service.client):
+            return {"success": False, "error": "Twilio not configured"}
+        return await twilio_service.send_sms_async(item["recipient"], item["content"])
+    if item["channel"] == "email":
+        if not (email_service and email_service.sg):
+            return {"success": False, "error": "SendGrid not configured"}
+        return await email_service.send_email_async(item["recipient"], item["subject"], item["content"])
+    return {"success": False, "error": f"Unknown channel {item['channel']}"}
+
+def outbox_result_update(item: dict, result: dict) -> UpdateOne:
+    """Build the status update recording a delivery attempt"""
+    now = datetime.utcnow()
+    update = {"claim_id": None, "locked_until": None, "updated_at": now}
+    if result["success"]:
+        update.update({"status": "sent", "sent_at": now, "last_error": None})
+    elif item["attempts"] >= item["max_attempts"]:
+        logger.error(f"Notification {item['id']} dead-lettered after {item['attempts']} attempts: {result['error']}")
+        update.update({"status": "dead", "last_error": result["error"]})
+    else:
+        delay = min(OUTBOX_RETRY_BASE_SECONDS * 2 ** (item["attempts"] - 1), OUTBOX_RETRY_MAX_SECONDS)
+        update.update({
+            "status": "pending",
+            "last_error": result["error"],
+            "next_attempt_at": now + timedelta(seconds=delay * random.uniform(0.8, 1.2))
+        })
+    return UpdateOne({"id": item["id"], "claim_id": item["claim_id"]}, {"$set": update})
+
+async def process_outbox_channel(channel: str, batch_size: int = OUTBOX_BATCH_SIZE) -> int:
+    """Claim and deliver one batch for a channel; returns the number of items processed"""
+    # Claim no more than the rate limit can send in half the lease, so items are never reclaimed mid-send
+    rate_limit = outbox_rate_limiters[channel]
+    batch_size = min(batch_size, max(1, int(rate_limit.rate_per_second * OUTBOX_LEASE_SECONDS / 2)))
+    items = await claim_outbox_batch(channel, batch_size)
+    if not items:
+        return 0
+    results = await asyncio.gather(*(deliver_notification(item) for item in items))
+    await db.notification_outbox.bulk_write(
+        [outbox_result_update(item, result) for item, result in zip(items, results)],
+        ordered=False
+    )
+    return len(items)
+
+# Bulk campaigns (run by notification_worker.py)
+CAMPAIGN_EMAIL_BATCH_SIZE = 1000  # SendGrid's personalization limit per request
+CAMPAIGN_SMS_BATCH_SIZE = int(os.environ.get('CAMPAIGN_SMS_BATCH_SIZE', '100'))
+CAMPAIGN_LEASE_SECONDS = float(os.environ.get('CAMPAIGN_LEASE_SECONDS', '300'))
+CAMPAIGN_VARIABLES = [
+    "first_name", "last_name", "email", "phone", "company",
+    "loyalty_tier", "loyalty_points", "referral_code"
+]
+
+def campaign_audience_query(channel: str, audience: CampaignAudience) -> dict:
+    """Customer query selecting a campaign's recipients"""
+    query = {}
+    if audience.marketing_consent:
+        query["marketing_consent"] = True
+    if audience.loyalty_tiers:
+        query["loyalty_tier"] = {"$in": audience.loyalty_tiers}
+    if audience.tags:
+        query["tags"] = {"$in": audience.tags}
+    if audience.customer_types:
+        query["customer_type"] = {"$in": audience.customer_types}
+    query["phone" if channel == "sms" else "email"] = {"$nin": [None, ""]}
+    return query
+
+def campaign_variables(customer: dict) -> Dict[str, str]:
+    return {name: "" if customer.get(name) is None else str(customer[name]) for name in CAMPAIGN_VARIABLES}
+
+async def claim_campaign() -> Optional[dict]:
+    """Claim a queued campaign, or a running one whose worker stopped heartbeating"""
+    now = datetime.utcnow()
+    return await db.notification_campaigns.find_one_and_update(
+        {"$or": [
+            {"status": "queued"},
+            {"status": "running", "heartbeat_at": {"$lte": now - timedelta(seconds=CAMPAIGN_LEASE_SECONDS)}}
+        ]},
+        {"$set": {"status": "running", "heartbeat_at": now, "lease_owner": str(uuid.uuid4())}},
+        sort=[("created_at", 1)],
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+async def send_campaign_email_batch(customers: List[dict], subject: str, content_template: Template) -> tuple:
+    """Send one SendGrid request for the batch; personalization uses substitution tags"""
+    tags = {name: f"-{name}-" for name in CAMPAIGN_VARIABLES}
+    html_content = content_template.render(**tags)
+    recipients = [
+        (customer["email"], {f"-{name}-": value for name, value in campaign_variables(customer).items()})
+        for customer in customers
+    ]
+    await campaign_rate_limiters["email"].acquire()
+    result = await email_service.send_bulk_email_async(
+        recipients, template_registry.from_string(subject or "").render(**tags), html_content
+    )
+    if not result["success"]:
+        logger.error(f"Campaign email batch failed: {result['error']}")
+        return 0, len(customers)
+    return len(customers), 0
+
+async def send_campaign_sms_batch(customers: List[dict], content_template: Template) -> tuple:
+    """Send the batch's SMS concurrently, bounded by the Twilio semaphore and campaign SMS rate limit"""
+    async def send(customer: dict) -> bool:
+        await campaign_rate_limiters["sms"].acquire()
+        message = content_template.render(**campaign_variables(customer))
+        result = await twilio_service.send_sms_async(customer["phone"], message)
+        return result["success"]
+    
+    results = await asyncio.gather(*(send(customer) for customer in customers))
+    sent = sum(results)
+    return sent, len(customers) - sent
+
+async def run_campaign(campaign: dict):
+    """Send a claimed campaign in batches, checkpointing progress after each batch"""
+    await configure_services()
+    # Every write is conditional on still holding the lease, so a run reclaimed after its
+    # lease expired stops sending instead of delivering alongside the new owner
+    lease = {"id": campaign["id"], "lease_owner": campaign["lease_owner"]}
+    subject, content = campaign.get("subject"), campaign.get("content")
+    if campaign.get("template_id"):
+        template = await db.notification_templates.find_one({"id": campaign["template_id"]}, {"_id": 0})
+        if not template:
+            await db.notification_campaigns.update_one(
+                lease,
+                {"$set": {"status": "failed", "last_error": "Template not found", "completed_at": datetime.utcnow()}}
+            )
+            return
+        subject, content_template = template.get("subject") or subject, template_registry.get_db_template(template)
+    else:
+        content_template = template_registry.from_string(content)
+    
+    channel = campaign["channel"]
+    if (channel == "email" and not email_service.sg) or (channel == "sms" and not twilio_service.client):
+        await db.notification_campaigns.update_one(
+            lease,
+            {"$set": {"status": "failed", "last_error": f"{channel} provider not configured", "completed_at": datetime.utcnow()}}
+        )
+        return
+    
+    query = campaign_audience_query(channel, CampaignAudience(**campaign["audience"]))
+    if campaign.get("cursor"):
+        query = {"$and": [query, keyset_filter(campaign["cursor"])]}
+    batch_size = CAMPAIGN_EMAIL_BATCH_SIZE if channel == "email" else CAMPAIGN_SMS_BATCH_SIZE
+    projection = {"_id": 0, "id": 1, "created_at": 1, **{name: 1 for name in CAMPAIGN_VARIABLES}}
+    customers = db.customers.find(query, projection).sort(DEFAULT_PAGE_SORT).batch_size(batch_size)
+    
+    if not campaign.get("started_at"):
+        await db.notification_campaigns.update_one(
+            lease, {"$set": {"started_at": datetime.utcnow()}}
+        )
+    started = time.monotonic()
+    processed = 0
+    
+    async def flush(batch: List[dict]) -> bool:
+        """Send one batch and checkpoint it; False once the lease has been lost"""
+        nonlocal processed
+        heartbeat = await db.notification_campaigns.update_one(lease, {"$set": {"heartbeat_at": datetime.utcnow()}})
+        if heartbeat.matched_count == 0:
+            return False
+        if channel == "email":
+            sent, failed = await send_campaign_email_batch(batch, subject, content_template)
+        else:
+            sent, failed = await send_campaign_sms_batch(batch, content_template)
+        processed += len(batch)
+        result = await db.notification_campaigns.update_one(
+            lease,
+            {
+                "$inc": {"sent": sent, "failed": failed},
+                "$set": {
+                    "cursor": encode_cursor(batch[-1]),
+                    "heartbeat_at": datetime.utcnow(),
+                    "messages_per_second": round(processed / max(time.monotonic() - started, 1e-6), 2)
+                }
+            }
+        )
+        return result.matched_count == 1
+    
+    batch = []
+    async for customer in customers:
+        batch.append(customer)
+        if len(batch) >= batch_size:
+            if not await flush(batch):
+                logger.warning(f"Campaign {campaign['id']} lease was taken over; stopping this run")
+                return
+            batch = []
+    if batch and not await flush(batch):
+        logger.warning(f"Campaign {campaign['id']} lease was taken over; stopping this run")
+        return
+    
+    await db.notification_campaigns.update_one(
+        lease,
+        {"$set": {"status": "completed", "completed_at": datetime.utcnow()}}
+    )
+    logger.info(f"Campaign {campaign['id']} completed: {processed} recipients processed")
+
+async def process_campaigns_once() -> int:
+    """Run the next claimable campaign to completion; returns the number of campaigns run"""
+    campaign = await claim_campaign()
+    if not campaign:
+        return 0
+    try:
+        await run_campaign(campaign)
+    except Exception as e:
+        logger.error(f"Campaign {campaign['id']} failed: {e}")
+        await db.notification_campaigns.update_one(
+            {"id": campaign["id"], "lease_owner": campaign["lease_owner"]},
+            {"$set": {"status": "failed", "last_error": str(e), "completed_at": datetime.utcnow()}}
+        )
+    return 1
+
+async def process_outbox_once(batch_size: int = OUTBOX_BATCH_SIZE) -> int:
+    """Process one batch per channel concurrently"""
+    await configure_services()
+    processed = await asyncio.gather(*(
+        process_outbox_channel(channel, batch_size) for channel in outbox_rate_limiters
+    ))
+    return sum(processed)
 
 # Advanced CRM Routes
 
+# Customer search: normalized tokens stored on each customer and matched by prefix
+SEARCH_TOKEN_SPLIT = re.compile(r"[^a-z0-9]+")
+MIN_PHONE_SUFFIX_LENGTH = 4
+
+def customer_search_tokens(customer: dict) -> List[str]:
+    """Lowercased name/email tokens plus phone digits and digit suffixes"""
+    tokens = set()
+    email = (customer.get("email") or "").lower().strip()
+    if email:
+        tokens.add(email)
+    # The email domain is shared by many customers, so only the local part is split
+    for value in (customer.get("first_name"), customer.get("last_name"), email.split("@")[0]):
+        value = (value or "").lower().strip()
+        if value:
+            tokens.add(value)
+            tokens.update(token for token in SEARCH_TOKEN_SPLIT.split(value) if token)
+    digits = re.sub(r"\D", "", customer.get("phone") or "")
+    # Suffixes let "123-0001" find "(555) 123-0001"
+    tokens.update(digits[i:] for i in range(len(digits) - MIN_PHONE_SUFFIX_LENGTH + 1))
+    return sorted(tokens)
+
+def customer_search_terms(search: str) -> List[str]:
+    """Normalize a search string into terms comparable with customer_search_tokens"""
+    terms = []
+    for term in search.lower().split():
+        digits = re.sub(r"\D", "", term)
+        if len(digits) >= 3 and not re.search(r"[a-z]", term):
+            terms.append(digits)
+        else:
+            terms.append(term)
+    return terms
+
+def customer_document(customer: Customer) -> dict:
+    """Customer as stored, including its search tokens"""
+    document = customer.dict()
+    document["search_tokens"] = customer_search_tokens(document)
+    return document
+
+async def backfill_customer_search_tokens(batch_size: int = 1000):
+    """Add search tokens to customers stored before search tokens existed"""
+    batch = []
+    async for customer in db.customers.find({"search_tokens": {"$exists": False}}, {"_id": 0}):
+        batch.append(UpdateOne({"id": customer["id"]}, {"$set": {"search_tokens": customer_search_tokens(customer)}}))
+        if len(batch) >= batch_size:
+            await db.customers.bulk_write(batch, ordered=False)
+            batch = []
+    if batch:
+        await db.customers.bulk_write(batch, ordered=False)
+
+CUSTOMER_SEARCH_SORT = [("search_rank", -1), ("created_at", 1), ("id", 1)]
+CUSTOMER_SEARCH_RANK_MIN_LENGTH = 3
+CUSTOMER_SEARCH_MAX_CANDIDATES = int(os.environ.get('CUSTOMER_SEARCH_MAX_CANDIDATES', '5000'))
+
 @api_router.get("/customers", response_model=List[Customer])
 async def get_customers(
+    response: Response,
     search: Optional[str] = None,
     customer_type: Optional[str] = None,
     loyalty_tier: Optional[str] = None,
-    limit: int = 100,
-    offset: int = 0
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None
 ):
-    """Get customers with filtering and search"""
+    """Get customers with filtering and ranked prefix search (next page cursor in X-Next-Cursor header;
+    X-Search-Truncated is set when a ranked search matched more customers than it can rank)"""
     query = {}
     if customer_type:
         query["customer_type"] = customer_type
     if loyalty_tier:
         query["loyalty_tier"] = loyalty_tier
     
-    if search:
-        query["$or"] = [
-            {"first_name": {"$regex": search, "$options": "i"}},
-            {"last_name": {"$regex": search, "$options": "i"}},
-            {"email": {"$regex": search, "$options": "i"}},
-            {"phone": {"$regex": search, "$options": "i"}}
-        ]
+    terms = customer_search_terms(search) if search else []
+    if terms:
+        # Anchored prefix regexes are answered from the search_tokens index
+        query["$and"] = [{"search_tokens": {"$regex": f"^{re.escape(term)}"}} for term in terms]
+    if not terms or max(len(term) for term in terms) < CUSTOMER_SEARCH_RANK_MIN_LENGTH:
+        # Short prefixes match too many customers to rank; page them in index order instead
+        customers = await paginate_find(
+            db.customers, query, response, limit, cursor, DEFAULT_PAGE_SORT, {"_id": 0, "search_tokens": 0}
+        )
+        return [Customer(**customer) for customer in customers]
+    
+    sort = CUSTOMER_SEARCH_SORT
+    page_stages = [{"$sort": dict(sort)}, {"$limit": limit + 1}]
+    if cursor:
+        page_stages.insert(0, {"$match": keyset_filter(cursor, sort)})
+    
+    async def rank_tier(tier_query: dict) -> tuple:
+        """Rank a bounded candidate set on its sort keys alone; returns the page and whether the cap was hit"""
+        result = await db.customers.aggregate([
+            {"$match": tier_query},
+            {"$limit": CUSTOMER_SEARCH_MAX_CANDIDATES},
+            {"$project": {
+                "_id": 0, "id": 1, "created_at": 1,
+                # Customers whose tokens match the terms exactly rank above prefix-only matches
+                "search_rank": {"$size": {"$setIntersection": ["$search_tokens", terms]}}
+            }},
+            {"$facet": {"page": page_stages, "candidates": [{"$count": "count"}]}}
+        ]).to_list(1)
+        candidates = result[0]["candidates"][0]["count"] if result and result[0]["candidates"] else 0
+        return (result[0]["page"] if result else []), candidates >= CUSTOMER_SEARCH_MAX_CANDIDATES
     
-    customers = await db.customers.find(query).skip(offset).limit(limit).to_list(limit)
+    # Customers with an exact token match come from the index first, so a cap on
+    # prefix-only matches can never push them out of the results
+    (exact, exact_truncated), (prefix, prefix_truncated) = await asyncio.gather(
+        rank_tier({**query, "search_tokens": {"$in": terms}}),
+        rank_tier({**query, "search_tokens": {"$nin": terms}})
+    )
+    if exact_truncated or prefix_truncated:
+        response.headers["X-Search-Truncated"] = "true"
+    ranked = sorted(
+        exact + prefix, key=lambda entry: (-entry["search_rank"], entry["created_at"], entry["id"])
+    )[:limit + 1]
+    if len(ranked) > limit:
+        ranked = ranked[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(ranked[-1], sort)
+    documents = {
+        customer["id"]: customer
+        async for customer in db.customers.find(
+            {"id": {"$in": [entry["id"] for entry in ranked]}}, {"_id": 0, "search_tokens": 0}
+        )
+    }
+    customers = [documents[entry["id"]] for entry in ranked if entry["id"] in documents]
     return [Customer(**customer) for customer in customers]
 
 @api_router.post("/customers", response_model=Customer)
@@ -1327,10 +3814,31 @@ async def create_customer(customer: Customer):
     if not customer.referral_code:
         customer.referral_code = f"REF{customer.first_name[:2].upper()}{customer.last_name[:2].upper()}{str(uuid.uuid4())[:6].upper()}"
     
-    customer_dict = customer.dict()
-    await db.customers.insert_one(customer_dict)
+    await db.customers.insert_one(customer_document(customer))
+    await link_customer_bookings(customer.id, customer.email)
     return customer
 
+@api_router.get("/customers/export")
+async def export_customers(
+    file_format: str = Query("ndjson", alias="format", pattern=BULK_FORMAT_PATTERN),
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    customer_type: Optional[str] = None,
+    marketing_consent: Optional[bool] = None,
+    fields: Optional[str] = None,
+    batch_size: int = Query(EXPORT_BATCH_SIZE, ge=100, le=10000)
+):
+    """Stream customers created in [start_date, end_date) as NDJSON or CSV; fields is a comma-separated projection"""
+    query = date_range_filter("created_at", start_date, end_date)
+    if customer_type:
+        query["customer_type"] = customer_type
+    if marketing_consent is not None:
+        query["marketing_consent"] = marketing_consent
+    # Columns come from the model, so internal fields like search_tokens are never exported
+    columns = export_fields(fields, Customer)
+    cursor = export_cursor(db.customers, query, columns, DEFAULT_PAGE_SORT, batch_size)
+    return export_response(cursor, file_format, "customers", columns, batch_size)
+
 @api_router.get("/customers/{customer_id}", response_model=Customer)
 async def get_customer(customer_id: str):
     """Get customer details"""
@@ -1339,25 +3847,82 @@ async def get_customer(customer_id: str):
         raise HTTPException(status_code=404, detail="Customer not found")
     return Customer(**customer)
 
+# Profile fields a customer update may change; loyalty balances, booking totals and
+# referral links are maintained by their own endpoints
+CUSTOMER_PROFILE_FIELDS = [
+    "email", "phone", "first_name", "last_name", "company", "address", "city", "state", "zip_code",
+    "customer_type", "acquisition_source", "marketing_consent", "tags", "notes"
+]
+
 @api_router.put("/customers/{customer_id}", response_model=Customer)
 async def update_customer(customer_id: str, customer: Customer):
-    """Update customer information"""
-    customer.last_activity = datetime.utcnow()
-    result = await db.customers.replace_one({"id": customer_id}, customer.dict())
-    if result.matched_count == 0:
+    """Update customer profile information"""
+    profile = customer.dict(include=set(CUSTOMER_PROFILE_FIELDS))
+    updated = await db.customers.find_one_and_update(
+        {"id": customer_id},
+        {"$set": {**profile, "search_tokens": customer_search_tokens(profile), "last_activity": datetime.utcnow()}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if not updated:
         raise HTTPException(status_code=404, detail="Customer not found")
-    return customer
+    return Customer(**updated)
 
-@api_router.get("/customers/{customer_id}/bookings")
-async def get_customer_bookings(customer_id: str):
-    """Get all bookings for a customer"""
-    bookings = await db.bookings.find({"customer_email": {"$exists": True}}).to_list(1000)
-    customer = await db.customers.find_one({"id": customer_id})
+CUSTOMER_BOOKINGS_SORT = [("created_at", -1), ("id", -1)]
+
+@api_router.get("/customers/{customer_id}/bookings", response_model=List[Booking])
+async def get_customer_bookings(
+    customer_id: str,
+    response: Response,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None
+):
+    """Get a customer's bookings, newest first (next page cursor in X-Next-Cursor header)"""
+    customer = await db.customers.find_one({"id": customer_id}, {"_id": 0, "id": 1})
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
     
-    customer_bookings = [booking for booking in bookings if booking.get("customer_email") == customer["email"]]
-    return customer_bookings
+    bookings = await paginate_find(
+        db.bookings, {"customer_id": customer_id}, response, limit, cursor, CUSTOMER_BOOKINGS_SORT
+    )
+    return [Booking(**booking) for booking in bookings]
+
+async def link_customer_bookings(customer_id: str, email: str):
+    """Attach unlinked bookings made with the customer's email and count them"""
+    result = await db.bookings.update_many(
+        {"customer_email": email, "customer_id": None},
+        {"$set": {"customer_id": customer_id}}
+    )
+    if result.modified_count:
+        await db.customers.update_one({"id": customer_id}, {"$inc": {"total_bookings": result.modified_count}})
+
+BACKFILL_LEASE_SECONDS = float(os.environ.get('BACKFILL_LEASE_SECONDS', '3600'))
+
+async def recount_customer_bookings():
+    """Set each customer's total_bookings from the bookings linked to them"""
+    await db.bookings.aggregate([
+        {"$match": {"customer_id": {"$ne": None}}},
+        {"$group": {"_id": "$customer_id", "total_bookings": {"$sum": 1}}},
+        {"$project": {"_id": 0, "id": "$_id", "total_bookings": 1}},
+        {"$merge": {"into": "customers", "on": "id", "whenMatched": "merge", "whenNotMatched": "discard"}}
+    ]).to_list(None)
+
+async def backfill_booking_customer_ids():
+    """Link bookings stored before customer_id existed to their customers by email, in one aggregation"""
+    owner = str(uuid.uuid4())
+    if not await acquire_lease("booking_customer_ids", owner, BACKFILL_LEASE_SECONDS):
+        return
+    try:
+        await db.bookings.aggregate([
+            {"$match": {"customer_id": None}},
+            {"$lookup": {"from": "customers", "localField": "customer_email", "foreignField": "email", "as": "customer"}},
+            {"$match": {"customer.0": {"$exists": True}}},
+            {"$project": {"_id": 1, "customer_id": {"$arrayElemAt": ["$customer.id", 0]}}},
+            {"$merge": {"into": "bookings", "on": "_id", "whenMatched": "merge", "whenNotMatched": "discard"}}
+        ]).to_list(None)
+        await recount_customer_bookings()
+    finally:
+        await release_lease("booking_customer_ids", owner)
 
 # Loyalty Program Routes
 
@@ -1369,7 +3934,9 @@ async def get_customer_loyalty(customer_id: str):
         raise HTTPException(status_code=404, detail="Customer not found")
     
     # Get loyalty transactions
-    transactions = await db.loyalty_transactions.find({"customer_id": customer_id}).sort("created_at", -1).to_list(100)
+    transactions = await db.loyalty_transactions.find(
+        {"customer_id": customer_id}, {"_id": 0}
+    ).sort("created_at", -1).to_list(100)
     
     return {
         "customer_id": customer_id,
@@ -1379,17 +3946,80 @@ async def get_customer_loyalty(customer_id: str):
         "transactions": transactions
     }
 
+# Ids of the most recent ledger entries applied to a customer, used to
+# recognise a retried entry that was applied before its ledger status was saved
+LOYALTY_RECENT_TRANSACTIONS = 50
+
+async def apply_loyalty_transaction(transaction: LoyaltyTransaction, require_balance: bool, recompute_tier: bool) -> dict:
+    """Record a ledger entry and apply it to the customer's balance exactly once"""
+    transaction.status = "pending"
+    try:
+        await db.loyalty_transactions.insert_one(transaction.dict())
+    except DuplicateKeyError:
+        existing = await db.loyalty_transactions.find_one(
+            {"idempotency_key": transaction.idempotency_key}, {"_id": 0}
+        )
+        if (existing["customer_id"], existing["points"]) != (transaction.customer_id, transaction.points):
+            raise HTTPException(status_code=409, detail="Idempotency key was used for a different request")
+        if existing["status"] == "applied":
+            return existing
+        if existing["status"] == "rejected":
+            raise HTTPException(status_code=400, detail="Insufficient points")
+        # An earlier attempt stopped midway; finish applying the same entry
+        transaction = LoyaltyTransaction(**existing)
+    
+    query = {"id": transaction.customer_id, "loyalty_transaction_ids": {"$ne": transaction.id}}
+    if require_balance:
+        query["loyalty_points"] = {"$gte": -transaction.points}
+    update = [{"$set": {
+        "loyalty_points": {"$add": [{"$ifNull": ["$loyalty_points", 0]}, transaction.points]},
+        "loyalty_transaction_ids": {"$slice": [
+            {"$concatArrays": [{"$ifNull": ["$loyalty_transaction_ids", []]}, [transaction.id]]},
+            -LOYALTY_RECENT_TRANSACTIONS
+        ]},
+        "last_activity": datetime.utcnow()
+    }}]
+    if recompute_tier:
+        update.append({"$set": {"loyalty_tier": loyalty_tier_expression("$loyalty_points")}})
+    
+    customer = await db.customers.find_one_and_update(
+        query, update,
+        projection={"_id": 0, "loyalty_points": 1, "loyalty_tier": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if customer is None:
+        current = await db.customers.find_one(
+            {"id": transaction.customer_id},
+            {"_id": 0, "loyalty_points": 1, "loyalty_tier": 1, "loyalty_transaction_ids": 1}
+        )
+        if current is None:
+            await db.loyalty_transactions.delete_one({"id": transaction.id})
+            raise HTTPException(status_code=404, detail="Customer not found")
+        if transaction.id in current.get("loyalty_transaction_ids", []):
+            customer = current
+        else:
+            await db.loyalty_transactions.update_one({"id": transaction.id}, {"$set": {"status": "rejected"}})
+            raise HTTPException(status_code=400, detail="Insufficient points")
+    
+    applied = {
+        "status": "applied",
+        "balance_after": customer.get("loyalty_points", 0),
+        "tier_after": customer.get("loyalty_tier", "bronze")
+    }
+    await db.loyalty_transactions.update_one({"id": transaction.id}, {"$set": applied})
+    return {**transaction.dict(), **applied}
+
 @api_router.post("/loyalty/award-points")
 async def award_loyalty_points(
     customer_id: str,
     points: int,
     description: str,
-    booking_id: Optional[str] = None
+    booking_id: Optional[str] = None,
+    idempotency_key: Optional[str] = Header(None)
 ):
-    """Award loyalty points to a customer"""
-    customer = await db.customers.find_one({"id": customer_id})
-    if not customer:
-        raise HTTPException(status_code=404, detail="Customer not found")
+    """Award loyalty points to a customer (send an Idempotency-Key header to make retries safe)"""
+    if points <= 0:
+        raise HTTPException(status_code=400, detail="Points must be positive")
     
     # Create loyalty transaction
     transaction = LoyaltyTransaction(
@@ -1397,60 +4027,35 @@ async def award_loyalty_points(
         transaction_type="earned",
         points=points,
         description=description,
-        booking_id=booking_id
-    )
-    await db.loyalty_transactions.insert_one(transaction.dict())
-    
-    # Update customer points and tier
-    new_points = customer.get("loyalty_points", 0) + points
-    new_tier = calculate_loyalty_tier(new_points)
-    
-    await db.customers.update_one(
-        {"id": customer_id},
-        {"$set": {
-            "loyalty_points": new_points,
-            "loyalty_tier": new_tier,
-            "last_activity": datetime.utcnow()
-        }}
+        booking_id=booking_id,
+        idempotency_key=idempotency_key
     )
+    applied = await apply_loyalty_transaction(transaction, require_balance=False, recompute_tier=True)
     
-    return {"message": "Points awarded successfully", "new_points": new_points, "new_tier": new_tier}
+    return {"message": "Points awarded successfully", "new_points": applied["balance_after"], "new_tier": applied["tier_after"]}
 
 @api_router.post("/loyalty/redeem-points")
 async def redeem_loyalty_points(
     customer_id: str,
     points: int,
-    description: str
+    description: str,
+    idempotency_key: Optional[str] = Header(None)
 ):
-    """Redeem loyalty points"""
-    customer = await db.customers.find_one({"id": customer_id})
-    if not customer:
-        raise HTTPException(status_code=404, detail="Customer not found")
-    
-    current_points = customer.get("loyalty_points", 0)
-    if current_points < points:
-        raise HTTPException(status_code=400, detail="Insufficient points")
+    """Redeem loyalty points (send an Idempotency-Key header to make retries safe)"""
+    if points <= 0:
+        raise HTTPException(status_code=400, detail="Points must be positive")
     
     # Create redemption transaction
     transaction = LoyaltyTransaction(
         customer_id=customer_id,
         transaction_type="redeemed",
         points=-points,
-        description=description
-    )
-    await db.loyalty_transactions.insert_one(transaction.dict())
-    
-    # Update customer points
-    new_points = current_points - points
-    await db.customers.update_one(
-        {"id": customer_id},
-        {"$set": {
-            "loyalty_points": new_points,
-            "last_activity": datetime.utcnow()
-        }}
+        description=description,
+        idempotency_key=idempotency_key
     )
+    applied = await apply_loyalty_transaction(transaction, require_balance=True, recompute_tier=False)
     
-    return {"message": "Points redeemed successfully", "new_points": new_points}
+    return {"message": "Points redeemed successfully", "new_points": applied["balance_after"]}
 
 # Referral System Routes
 
@@ -1476,19 +4081,29 @@ async def create_referral(referrer_id: str, referred_email: str):
     await db.referrals.insert_one(referral.dict())
     return referral
 
-@api_router.get("/referrals/{referrer_id}")
-async def get_referrals(referrer_id: str):
-    """Get all referrals by a customer"""
-    referrals = await db.referrals.find({"referrer_id": referrer_id}).to_list(100)
-    return referrals
+@api_router.get("/referrals/{referrer_id}", response_model=List[Referral])
+async def get_referrals(
+    referrer_id: str,
+    response: Response,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None
+):
+    """Get referrals by a customer (next page cursor in X-Next-Cursor header)"""
+    referrals = await paginate_find(db.referrals, {"referrer_id": referrer_id}, response, limit, cursor)
+    return [Referral(**referral) for referral in referrals]
 
 # Location Management Routes
 
 @api_router.get("/locations", response_model=List[Location])
-async def get_locations(active_only: bool = True):
-    """Get all locations"""
+async def get_locations(
+    response: Response,
+    active_only: bool = True,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None
+):
+    """Get locations (next page cursor in X-Next-Cursor header)"""
     query = {"is_active": True} if active_only else {}
-    locations = await db.locations.find(query).to_list(100)
+    locations = await paginate_find(db.locations, query, response, limit, cursor)
     return [Location(**location) for location in locations]
 
 @api_router.post("/locations", response_model=Location)
@@ -1508,15 +4123,16 @@ async def update_location(location_id: str, location: Location):
 
 # Brand Settings Routes
 
-@api_router.get("/brand-settings")
-async def get_brand_settings(location_id: Optional[str] = None):
+@api_router.get("/brand-settings", response_model=BrandSettings)
+async def get_brand_settings(request: Request, location_id: Optional[str] = None):
     """Get brand settings for location or global"""
-    query = {"location_id": location_id} if location_id else {"location_id": None}
-    settings = await db.brand_settings.find_one(query)
-    if not settings:
-        # Return default settings
-        return BrandSettings().dict()
-    return settings
+    async def load_settings():
+        settings = await db.brand_settings.find_one({"location_id": location_id}, {"_id": 0})
+        # Fall back to default settings
+        return (BrandSettings(**settings) if settings else BrandSettings()).model_dump_json().encode()
+    
+    body, etag, _ = await brand_settings_cache.get(location_id, load_settings)
+    return cached_json_response(request, body, etag)
 
 @api_router.post("/brand-settings", response_model=BrandSettings)
 async def create_brand_settings(settings: BrandSettings):
@@ -1536,6 +4152,7 @@ async def create_brand_settings(settings: BrandSettings):
         # Create new
         await db.brand_settings.insert_one(settings.dict())
     
+    brand_settings_cache.invalidate()
     return settings
 
 # Push Notification Routes
@@ -1566,46 +4183,53 @@ async def send_push_notification(
     if customer_id:
         query["customer_id"] = customer_id
     
-    subscriptions = await db.push_subscriptions.find(query).to_list(1000)
-    
     # Here you would integrate with a push service like Firebase
+    subscribers = await db.push_subscriptions.count_documents(query)
+    
     # For now, we'll just log the attempt
-    logger.info(f"Would send push notification to {len(subscriptions)} subscribers: {title}")
+    logger.info(f"Would send push notification to {subscribers} subscribers: {title}")
     
-    return {"message": f"Push notification queued for {len(subscriptions)} subscribers"}
+    return {"message": f"Push notification queued for {subscribers} subscribers"}
 
 # Helper functions
+# Minimum points per tier, highest first
+LOYALTY_TIERS = [(5000, "platinum"), (2500, "gold"), (1000, "silver")]
+
 def calculate_loyalty_tier(points: int) -> str:
     """Calculate loyalty tier based on points"""
-    if points >= 5000:
-        return "platinum"
-    elif points >= 2500:
-        return "gold"
-    elif points >= 1000:
-        return "silver"
-    else:
-        return "bronze"
+    for threshold, tier in LOYALTY_TIERS:
+        if points >= threshold:
+            return tier
+    return "bronze"
+
+def loyalty_tier_expression(points: str) -> dict:
+    """Aggregation expression equivalent to calculate_loyalty_tier"""
+    return {"$switch": {
+        "branches": [{"case": {"$gte": [points, threshold]}, "then": tier} for threshold, tier in LOYALTY_TIERS],
+        "default": "bronze"
+    }}
+
+# Collections replaced by the sample data, and derived state rebuilt from them
+SAMPLE_DATA_COLLECTIONS = [
+    "physical_units", "virtual_units", "bookings", "unit_holds", "image_assets", "content_blocks",
+    "promo_banners", "funnel_events", "funnel_rollups", "funnel_sessions", "api_keys",
+    "payment_transactions", "customers", "locations", "loyalty_transactions", "referrals",
+    "brand_settings", "push_subscriptions"
+]
+
+def invalidate_sample_data_caches():
+    """Drop in-process caches over the collections replaced by seeding"""
+    credentials_cache.invalidate()
+    content_cache.invalidate()
+    brand_settings_cache.invalidate()
+    banner_index.invalidate()
 
 @api_router.post("/initialize-sample-data")
 async def initialize_sample_data():
     """Initialize the system with sample data"""
     
     # Clear existing data
-    await db.physical_units.delete_many({})
-    await db.virtual_units.delete_many({})
-    await db.bookings.delete_many({})
-    await db.image_assets.delete_many({})
-    await db.content_blocks.delete_many({})
-    await db.promo_banners.delete_many({})
-    await db.funnel_events.delete_many({})
-    await db.api_keys.delete_many({})
-    await db.payment_transactions.delete_many({})
-    await db.customers.delete_many({})
-    await db.locations.delete_many({})
-    await db.loyalty_transactions.delete_many({})
-    await db.referrals.delete_many({})
-    await db.brand_settings.delete_many({})
-    await db.push_subscriptions.delete_many({})
+    await asyncio.gather(*(db[collection_name].delete_many({}) for collection_name in SAMPLE_DATA_COLLECTIONS))
     
     # Create sample locations
     locations = [
@@ -1654,9 +4278,6 @@ async def initialize_sample_data():
         )
     ]
     
-    for location in locations:
-        await db.locations.insert_one(location.dict())
-    
     # Create sample customers
     customers = [
         Customer(
@@ -1701,9 +4322,6 @@ async def initialize_sample_data():
         )
     ]
     
-    for customer in customers:
-        await db.customers.insert_one(customer.dict())
-    
     # Create sample loyalty transactions
     loyalty_transactions = [
         LoyaltyTransaction(
@@ -1732,9 +4350,6 @@ async def initialize_sample_data():
         )
     ]
     
-    for transaction in loyalty_transactions:
-        await db.loyalty_transactions.insert_one(transaction.dict())
-    
     # Create sample referrals
     referrals = [
         Referral(
@@ -1754,9 +4369,6 @@ async def initialize_sample_data():
         )
     ]
     
-    for referral in referrals:
-        await db.referrals.insert_one(referral.dict())
-    
     # Create default brand settings
     brand_settings = BrandSettings(
         location_id=None,  # Global settings
@@ -1774,8 +4386,6 @@ async def initialize_sample_data():
         }
     )
     
-    await db.brand_settings.insert_one(brand_settings.dict())
-    
     # Create sample content blocks
     content_blocks = [
         ContentBlock(
@@ -1834,9 +4444,6 @@ async def initialize_sample_data():
         )
     ]
     
-    for content in content_blocks:
-        await db.content_blocks.insert_one(content.dict())
-    
     # Create sample promotional banners
     promo_banners = [
         PromoBanner(
@@ -1901,9 +4508,6 @@ async def initialize_sample_data():
         )
     ]
     
-    for banner in promo_banners:
-        await db.promo_banners.insert_one(banner.dict())
-    
     # Create sample image assets
     image_assets = [
         # Hero Images
@@ -2026,9 +4630,6 @@ async def initialize_sample_data():
         )
     ]
     
-    for image in image_assets:
-        await db.image_assets.insert_one(image.dict())
-    
     # Create sample physical units
     physical_units = [
         PhysicalUnit(
@@ -2061,9 +4662,6 @@ async def initialize_sample_data():
         )
     ]
     
-    for unit in physical_units:
-        await db.physical_units.insert_one(unit.dict())
-    
     # Create sample virtual units (multiple virtual units per physical unit)
     virtual_units = []
     
@@ -2183,8 +4781,20 @@ async def initialize_sample_data():
         )
     ])
     
-    for unit in virtual_units:
-        await db.virtual_units.insert_one(unit.dict())
+    await asyncio.gather(
+        db.locations.insert_many([location.dict() for location in locations]),
+        db.customers.insert_many([customer_document(customer) for customer in customers]),
+        db.loyalty_transactions.insert_many([transaction.dict() for transaction in loyalty_transactions]),
+        db.referrals.insert_many([referral.dict() for referral in referrals]),
+        db.brand_settings.insert_one(brand_settings.dict()),
+        db.content_blocks.insert_many([content.dict() for content in content_blocks]),
+        db.promo_banners.insert_many([banner.dict() for banner in promo_banners]),
+        db.image_assets.insert_many([image.dict() for image in image_assets]),
+        db.physical_units.insert_many([unit.dict() for unit in physical_units]),
+        db.virtual_units.insert_many([unit.dict() for unit in virtual_units])
+    )
+    invalidate_sample_data_caches()
+    await refresh_filter_facets()
     
     return {
         "message": "Sample data initialized successfully",
@@ -2209,7 +4819,14 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Search-Truncated", "ETag"],
 )
+app.add_middleware(RequestMetricsMiddleware)
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Per-route request metrics in the Prometheus text format"""
+    return PlainTextResponse(route_metrics.render(), media_type="text/plain; version=0.0.4")
 
 # Configure logging
 logging.basicConfig(
@@ -2218,6 +4835,35 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def startup_db_indexes():
+    await configure_funnel_events_collection()
+    await run_migration("unit_holds_window_scoped", migrate_unit_hold_indexes)
+    await ensure_indexes()
+    try:
+        report = await get_index_usage_report()
+    except OperationFailure as e:
+        logger.warning(f"Index usage report unavailable: {e}")
+        return
+    for collection_name, collection_report in report.items():
+        if collection_report["unused"]:
+            logger.info(f"Unused indexes on {collection_name}: {', '.join(collection_report['unused'])}")
+
+@app.on_event("startup")
+async def startup_migrations():
+    await run_migration("customer_search_tokens", backfill_customer_search_tokens)
+
+@app.on_event("startup")
+async def startup_integrations():
+    template_registry.warm()
+    await configure_services()
+    background_tasks.append(asyncio.create_task(watch_api_key_changes()))
+    background_tasks.append(asyncio.create_task(funnel_event_buffer.run()))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await funnel_event_buffer.flush()
     client.close()
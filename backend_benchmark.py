@@ -0,0 +1,274 @@
+"""
+Async load test for the storage API.
+
+Runs concurrent virtual users through weighted scenario mixes (storefront browse,
+filter, book, admin dashboard, funnel tracking) and reports p50/p95/p99 latency
+and throughput per route. Results can be saved as a baseline and compared
+against later runs to catch regressions.
+
+    # In-process against the FastAPI app (uses MONGO_URL/DB_NAME from backend/.env)
+    python backend_benchmark.py --duration 30 --concurrency 50 --save-baseline baseline.json
+
+    # Against a running server
+    python backend_benchmark.py --base-url http://localhost:8001/api --compare baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import httpx
+
+SCENARIOS = ["browse", "filter", "book", "admin", "tracking"]
+DEFAULT_MIX = "browse=45,filter=20,book=5,admin=5,tracking=25"
+FUNNEL_STAGES = ["visitor", "viewing_units", "filtering", "booking_started", "booking_abandoned", "returning_visitor"]
+UNIT_TYPES = ["enclosed_parking", "self_storage", "outdoor_parking", "covered_parking"]
+SEARCH_TERMS = ["john", "sarah", "smith", "mike", "garcia", "example"]
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class BackendBenchmark:
+    def __init__(self, client, mix, write_bookings=False, seed=None):
+        self.client = client
+        self.mix = mix
+        self.write_bookings = write_bookings
+        self.rng = random.Random(seed)
+        self.virtual_unit_ids = []
+        self.samples = {}
+        self.statuses = {}
+        self.elapsed = 0.0
+
+    async def request(self, route, method, path, **kwargs):
+        """Time a request and record it under its route template"""
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, path, **kwargs)
+            status = response.status_code
+        except httpx.HTTPError as e:
+            response, status = None, type(e).__name__
+        self.samples.setdefault(route, []).append((time.perf_counter() - start) * 1000)
+        statuses = self.statuses.setdefault(route, {})
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        return response
+
+    async def setup(self):
+        """Collect unit ids the scenarios pick from"""
+        response = await self.client.get("virtual-units", params={"limit": 1000})
+        response.raise_for_status()
+        self.virtual_unit_ids = [unit["id"] for unit in response.json()]
+        if not self.virtual_unit_ids:
+            raise SystemExit("No virtual units found; seed the database first (backend/generate_load_data.py)")
+
+    # Scenarios
+
+    async def browse(self, session_id):
+        await self.request("GET /content", "GET", "content")
+        await self.request("GET /brand-settings", "GET", "brand-settings")
+        await self.request("GET /funnel/user/{session_id}", "GET", f"funnel/user/{session_id}")
+        await self.request("GET /banners?active_only", "GET", "banners", params={
+            "active_only": "true", "funnel_stage": self.rng.choice(FUNNEL_STAGES)
+        })
+        await self.request("GET /filter-options", "GET", "filter-options")
+        await self.request("GET /virtual-units", "GET", "virtual-units", params={"limit": 50})
+
+    async def filter(self, session_id):
+        unit_type = self.rng.choice(UNIT_TYPES)
+        max_price = self.rng.choice([100, 200, 300, 500])
+        params = {"unit_type": unit_type, "max_price": max_price, "pricing_period": "monthly"}
+        await self.request("GET /virtual-units?filters", "GET", "virtual-units", params={**params, "limit": 50})
+        await self.request("GET /filter-options?filters", "GET", "filter-options", params=params)
+        start = datetime.utcnow() + timedelta(days=self.rng.randint(1, 60))
+        await self.request("GET /virtual-units?availability", "GET", "virtual-units", params={
+            "availability_date": start.isoformat(),
+            "availability_end_date": (start + timedelta(days=30)).isoformat(),
+            "limit": 50
+        })
+
+    async def book(self, session_id):
+        unit_id = self.rng.choice(self.virtual_unit_ids)
+        await self.request("GET /virtual-units/{id}", "GET", f"virtual-units/{unit_id}")
+        # A one-day window far out keeps repeated runs from exhausting inventory
+        start = datetime.utcnow() + timedelta(days=self.rng.randint(365, 3650))
+        window = {"start_date": start.isoformat(), "end_date": (start + timedelta(days=1)).isoformat()}
+        response = await self.request("POST /bookings/holds", "POST", "bookings/holds", params={
+            "virtual_unit_id": unit_id, **window
+        })
+        if response is None or response.status_code != 200:
+            return
+        hold_id = response.json()["hold_id"]
+        if not self.write_bookings:
+            await self.request("DELETE /bookings/holds/{id}", "DELETE", f"bookings/holds/{hold_id}")
+            return
+        await self.request("POST /bookings", "POST", "bookings", json={
+            "virtual_unit_id": unit_id,
+            "customer_name": "Load Test",
+            "customer_email": f"{session_id}@loadtest.example.com",
+            "customer_phone": "+15550000000",
+            "payment_option": "pay_later_move_later",
+            "pricing_period": "daily",
+            "hold_id": hold_id,
+            **window
+        })
+
+    async def admin(self, session_id):
+        await self.request("GET /admin/analytics", "GET", "admin/analytics")
+        await self.request("GET /admin/analytics/timeseries", "GET", "admin/analytics/timeseries", params={"days": 30})
+        await self.request("GET /customers?search", "GET", "customers", params={
+            "search": self.rng.choice(SEARCH_TERMS), "limit": 50
+        })
+        await self.request("GET /customers", "GET", "customers", params={"limit": 100})
+
+    async def tracking(self, session_id):
+        events = [
+            {"session_id": session_id, "event_type": self.rng.choice(["page_view", "unit_viewed", "filter_used"]),
+             "metadata": {"page": "home"}}
+            for _ in range(self.rng.randint(1, 20))
+        ]
+        await self.request("POST /funnel/track/batch", "POST", "funnel/track/batch", json=events)
+        await self.request("POST /funnel/track", "POST", "funnel/track", json={
+            "session_id": session_id, "event_type": "page_view", "metadata": {"page": "home"}
+        })
+
+    async def virtual_user(self, deadline):
+        session_id = f"bench_{uuid.uuid4().hex[:12]}"
+        scenarios, weights = zip(*self.mix.items())
+        while time.perf_counter() < deadline:
+            scenario = self.rng.choices(scenarios, weights)[0]
+            await getattr(self, scenario)(session_id)
+
+    async def run(self, duration, concurrency):
+        await self.setup()
+        start = time.perf_counter()
+        await asyncio.gather(*(self.virtual_user(start + duration) for _ in range(concurrency)))
+        self.elapsed = time.perf_counter() - start
+
+    def results(self):
+        routes = {}
+        for route, samples in sorted(self.samples.items()):
+            samples = sorted(samples)
+            statuses = self.statuses[route]
+            routes[route] = {
+                "count": len(samples),
+                "errors": sum(count for status, count in statuses.items() if not status.isdigit() or int(status) >= 500),
+                "statuses": statuses,
+                "p50_ms": round(percentile(samples, 0.50), 2),
+                "p95_ms": round(percentile(samples, 0.95), 2),
+                "p99_ms": round(percentile(samples, 0.99), 2),
+                "mean_ms": round(sum(samples) / len(samples), 2),
+                "rps": round(len(samples) / self.elapsed, 2)
+            }
+        total = sum(route["count"] for route in routes.values())
+        return {
+            "timestamp": datetime.utcnow().isoformat(),
+            "elapsed_seconds": round(self.elapsed, 2),
+            "total_requests": total,
+            "total_rps": round(total / self.elapsed, 2) if self.elapsed else 0,
+            "mix": self.mix,
+            "routes": routes
+        }
+
+
+def print_results(results):
+    print(f"\n📊 {results['total_requests']} requests in {results['elapsed_seconds']}s "
+          f"({results['total_rps']} req/s)\n")
+    print(f"{'route':<36} {'count':>7} {'err':>5} {'p50':>9} {'p95':>9} {'p99':>9} {'rps':>8}")
+    for route, stats in results["routes"].items():
+        print(f"{route:<36} {stats['count']:>7} {stats['errors']:>5} {stats['p50_ms']:>8.1f}ms "
+              f"{stats['p95_ms']:>8.1f}ms {stats['p99_ms']:>8.1f}ms {stats['rps']:>8.1f}")
+
+
+def compare_results(results, baseline, threshold):
+    """Print per-route p95 and throughput changes, returning the routes that regressed"""
+    regressions = []
+    print(f"\n🔍 Compared with baseline from {baseline['timestamp']} (threshold {threshold:.0%})\n")
+    for route, stats in results["routes"].items():
+        previous = baseline["routes"].get(route)
+        if not previous or not previous["p95_ms"]:
+            print(f"{route:<36} new route")
+            continue
+        change = stats["p95_ms"] / previous["p95_ms"] - 1
+        regressed = change > threshold
+        marker = "❌" if regressed else "✅"
+        print(f"{marker} {route:<34} p95 {previous['p95_ms']:>8.1f}ms -> {stats['p95_ms']:>8.1f}ms ({change:+.0%})  "
+              f"rps {previous['rps']:>8.1f} -> {stats['rps']:>8.1f}")
+        if regressed:
+            regressions.append(route)
+    return regressions
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"unknown scenario {name!r}; choose from {', '.join(SCENARIOS)}")
+        mix[name.strip()] = float(weight or 1)
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+
+async def run_benchmark(args):
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    if args.base_url:
+        base_url = args.base_url.rstrip("/") + "/"
+        async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+            benchmark = BackendBenchmark(client, args.mix, args.write_bookings, args.seed)
+            await benchmark.run(args.duration, args.concurrency)
+        return benchmark.results()
+
+    # In-process: drive the ASGI app directly, running its startup and shutdown handlers
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+    from server import app
+
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark/api/", timeout=args.timeout) as client:
+            benchmark = BackendBenchmark(client, args.mix, args.write_bookings, args.seed)
+            await benchmark.run(args.duration, args.concurrency)
+    return benchmark.results()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Async load test for the storage API")
+    parser.add_argument("--base-url", help="API base URL including /api; runs the app in-process when omitted")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run")
+    parser.add_argument("--concurrency", type=int, default=20, help="concurrent virtual users")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"scenario weights (default {DEFAULT_MIX})")
+    parser.add_argument("--write-bookings", action="store_true", help="complete bookings instead of releasing holds")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--save-baseline", metavar="PATH", help="write results as JSON")
+    parser.add_argument("--compare", metavar="PATH", help="compare against a saved baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="p95 increase counted as a regression")
+    args = parser.parse_args()
+
+    results = asyncio.run(run_benchmark(args))
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved baseline to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"\n❌ {len(regressions)} route(s) regressed: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
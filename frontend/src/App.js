@@ -18,19 +18,51 @@ const getSessionId = () => {
   return sessionId;
 };
 
-// Funnel tracking utility
-const trackEvent = async (eventType, metadata = {}) => {
+// Funnel tracking utility: events are queued and sent in batches
+const TRACK_BATCH_SIZE = 20;
+const TRACK_FLUSH_MS = 2000;
+let trackQueue = [];
+let trackTimer = null;
+
+const flushEvents = async ({ keepalive = false } = {}) => {
+  clearTimeout(trackTimer);
+  trackTimer = null;
+  if (trackQueue.length === 0) return;
+  const events = trackQueue;
+  trackQueue = [];
   try {
-    await axios.post(`${API}/funnel/track`, {
-      session_id: getSessionId(),
-      event_type: eventType,
-      metadata
-    });
+    if (keepalive) {
+      // Survives the page being unloaded, unlike an axios request
+      await fetch(`${API}/funnel/track/batch`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(events),
+        keepalive: true
+      });
+    } else {
+      await axios.post(`${API}/funnel/track/batch`, events);
+    }
   } catch (err) {
-    console.error('Failed to track event:', err);
+    console.error('Failed to track events:', err);
   }
 };
 
+const trackEvent = (eventType, metadata = {}) => {
+  trackQueue.push({
+    session_id: getSessionId(),
+    event_type: eventType,
+    timestamp: new Date().toISOString(),
+    metadata
+  });
+  if (trackQueue.length >= TRACK_BATCH_SIZE) {
+    flushEvents();
+  } else if (!trackTimer) {
+    trackTimer = setTimeout(flushEvents, TRACK_FLUSH_MS);
+  }
+};
+
+window.addEventListener('pagehide', () => flushEvents({ keepalive: true }));
+
 const PromoBanner = ({ banner, onClose }) => {
   if (!banner) return null;
 